@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+
+__doc__='''
+Throughput benchmark of the Optimizer, end to end, without GULP.
+
+For every combination of population and fit set sizes, builds an Optimizer
+on a synthetic dataset, evaluates a first generation, then times
+create_generation and bulk_evaluate (and, through the optimizer's profiler,
+fitness and the dispatch of evaluations to workers) over a few generations.
+GULP is replaced by fake_gulp.py (see there for its latency and failure
+knobs), unless --evaluator native.
+
+    python benchmarks/bench_optimizer.py --pop-sizes 50,100 --fit-sizes 5,20 \\
+        --latency 0.01 --output results.json
+
+Results are written as JSON: the settings, the machine, and one record per
+configuration with organism-evaluations per second, the per-generation
+latency of each phase (mean, min, max, in seconds) and memory (peak RSS, and
+the RSS growth over each phase, in kB). Given --baseline (an earlier results
+file), configurations whose throughput dropped by more than --tolerance are
+reported, and the exit status is 1.
+'''
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_GULP = os.path.join(ROOT, 'benchmarks', 'fake_gulp.py')
+PHASES = ['create_generation', 'bulk_evaluate', 'fitness', 'dispatch']
+
+def rss():
+    '''Resident memory of this process, in kB.'''
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages*resource.getpagesize()//1024
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def peak_rss():
+    '''Peak resident memory of this process, in kB (ru_maxrss on Linux).'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def synthetic_data(n, natoms, seed=0, species=('Al',), a=4.05):
+    '''
+    n snapshots of natoms atoms each: cubic cells sized for the density of
+    fcc aluminium, atoms at random fractional coordinates, and made up
+    energies, forces and stresses.
+    '''
+    import numpy as np
+    from fitpot import Data
+    rng = np.random.RandomState(seed)
+    side = a*(natoms/4.0)**(1.0/3)
+    datas = []
+    for i in range(n):
+        d = Data()
+        d.cell = (side*(1 + 0.02*rng.randn())*np.eye(3)).tolist()
+        d.coords = [ (species[j % len(species)], rng.rand(3).tolist())
+                for j in range(natoms) ]
+        d.energy = -3.4*natoms*(1 + 0.05*rng.randn())
+        d.forces = rng.randn(natoms, 3).tolist()
+        d.stresses = rng.randn(6).tolist()
+        datas.append(d)
+    return datas
+
+def make_optimizer(genome, data, pop_size, fit_size, args):
+    from fitpot import Optimizer
+    opt = Optimizer(genome)
+    opt.data.extend(data)
+    opt.pop_size = pop_size
+    opt.fit_size = fit_size
+    opt.first_generation_factor = 1
+    opt.processes = args.processes
+    opt.engine = args.engine
+    opt.evaluator = args.evaluator
+    opt.batch_structures = args.batch_structures
+    opt.seed = args.seed
+    opt.checkpoint_every = 0
+    ## as _run would with profile on, for the fitness and dispatch timings
+    opt.profiler.enabled = True
+    return opt
+
+def timed(f):
+    start, before = time.time(), rss()
+    f()
+    return time.time()-start, rss()-before
+
+def stats(values):
+    if not values:
+        return None
+    return {'mean': sum(values)/len(values), 'min': min(values),
+            'max': max(values)}
+
+def run_case(genome, data, pop_size, fit_size, args):
+    '''Benchmarks one configuration, returning its record.'''
+    import random
+    import numpy as np
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    opt = make_optimizer(genome, data, pop_size, fit_size, args)
+    latency = dict( (p, []) for p in PHASES )
+    memory = {'create_generation': [], 'bulk_evaluate': []}
+    organisms = evaluations = failures = 0
+    try:
+        opt.select_fit_data()
+        opt.initialize_population()
+        opt.evaluate_next()
+        opt.profiler.reset()
+        for g in range(args.generations):
+            seconds, grown = timed(opt.create_generation)
+            latency['create_generation'].append(seconds)
+            memory['create_generation'].append(grown)
+            n = len(opt.generations[-1])
+            seconds, grown = timed(opt.evaluate_next)
+            latency['bulk_evaluate'].append(seconds)
+            memory['bulk_evaluate'].append(grown)
+            organisms += n
+            summary = opt.profiler.summary()
+            for phase in ['fitness', 'dispatch']:
+                latency[phase].append(summary['seconds'].get(phase, 0.0))
+            evaluations += summary['counters'].get('evaluations', 0)
+            failures += summary['counters'].get('failures', 0)
+    finally:
+        if opt.pool is not None:
+            opt.pool.close()
+        if opt.scheduler is not None:
+            opt.scheduler.close()
+    evaluate = sum(latency['bulk_evaluate'])
+    dispatch = sum(latency['dispatch'])
+    return {'pop_size': pop_size, 'fit_size': fit_size,
+            'organisms': organisms,
+            'evaluations': evaluations,
+            'failures': failures,
+            'organism_evals_per_sec': (organisms*fit_size/evaluate
+                if evaluate else None),
+            'gulp_runs_per_sec': evaluations/dispatch if dispatch else None,
+            'latency': dict( (p, stats(v)) for p, v in latency.items() ),
+            'rss_growth_kb': dict( (p, stats(v)) for p, v in memory.items() ),
+            'peak_rss_kb': peak_rss()}
+
+def key(record):
+    return (record['pop_size'], record['fit_size'])
+
+def compare(baseline, results, tolerance):
+    '''
+    Prints how throughput changed since baseline, returning the
+    configurations which slowed down by more than tolerance.
+    '''
+    before = dict( (key(r), r) for r in baseline['results'] )
+    regressions = []
+    for r in results['results']:
+        old = before.get(key(r))
+        if old is None or not old['organism_evals_per_sec']:
+            continue
+        ratio = r['organism_evals_per_sec']/old['organism_evals_per_sec']
+        print >>sys.stderr, ('pop %4d fit %4d: %8.1f -> %8.1f evals/s (%+.1f%%)'
+                % (key(r) + (old['organism_evals_per_sec'],
+                    r['organism_evals_per_sec'], 100*(ratio-1))))
+        if ratio < 1 - tolerance:
+            regressions.append(key(r))
+    return regressions
+
+def sizes(text):
+    return [ int(x) for x in text.split(',') ]
+
+def arguments(argv=None):
+    parser = argparse.ArgumentParser(description='fitpot throughput benchmark')
+    parser.add_argument('--pop-sizes', type=sizes, default=[20, 50])
+    parser.add_argument('--fit-sizes', type=sizes, default=[5, 10])
+    parser.add_argument('--snapshots', type=int, default=50,
+            help='snapshots in the synthetic dataset')
+    parser.add_argument('--atoms', type=int, default=32,
+            help='atoms per snapshot')
+    parser.add_argument('--generations', type=int, default=3)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--engine', default='pool',
+            choices=['pool', 'scheduler'])
+    parser.add_argument('--evaluator', default='gulp',
+            choices=['gulp', 'native'])
+    parser.add_argument('--batch-structures', action='store_true')
+    parser.add_argument('--latency', type=float, default=0.0,
+            help='seconds each fake GULP run takes')
+    parser.add_argument('--jitter', type=float, default=0.0,
+            help='up to this many more seconds, at random')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+            help='share of fake GULP runs which fail')
+    parser.add_argument('--gulp', default=FAKE_GULP,
+            help='GULP executable (default: the stand-in)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None,
+            help='write the results (JSON) here rather than to stdout')
+    parser.add_argument('--baseline', default=None,
+            help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+            help='slowdown against the baseline allowed before failing')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = arguments(argv)
+    ## fitpot reads these when it is imported, and its workers inherit them
+    os.environ['FITPOT_GULP_CMD'] = args.gulp
+    os.environ['FITPOT_FAKE_GULP_LATENCY'] = str(args.latency)
+    os.environ['FITPOT_FAKE_GULP_JITTER'] = str(args.jitter)
+    os.environ['FITPOT_FAKE_GULP_FAILURE'] = str(args.failure_rate)
+    sys.path.insert(0, ROOT)
+    from fitpot.library import LennardJones
+
+    genome = LennardJones(elements=['Al']).genome
+    data = synthetic_data(args.snapshots, args.atoms, args.seed)
+    results = {'settings': vars(args),
+            'machine': {'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.sysconf('SC_NPROCESSORS_ONLN')},
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': []}
+    try:
+        results['commit'] = subprocess.check_output(['git', 'rev-parse',
+            'HEAD'], cwd=ROOT, stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        results['commit'] = None
+
+    ## the optimizer's progress messages would get mixed into the results
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        for pop_size in args.pop_sizes:
+            for fit_size in args.fit_sizes:
+                if fit_size > args.snapshots:
+                    continue
+                record = run_case(genome, data, pop_size, fit_size, args)
+                results['results'].append(record)
+                print 'pop %4d fit %4d: %8.1f evals/s' % (pop_size, fit_size,
+                        record['organism_evals_per_sec'] or 0)
+    finally:
+        sys.stdout = stdout
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text+'\n')
+    else:
+        print text
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        if regressions:
+            print >>sys.stderr, 'slower than the baseline:', regressions
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
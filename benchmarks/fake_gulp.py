@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import random
+import zlib
+
+__doc__='''
+Stand-in for the GULP executable, for benchmarking without GULP.
+
+Reads a GULP input, as fitpot renders it, on stdin and writes a well-formed
+frc file (an energy, cartesian gradients and strain derivatives for every
+structure) to the file named by its "output frc" line. The numbers are made
+up, but depend on the whole input, so different potentials get different
+errors and identical inputs identical results.
+
+    FITPOT_FAKE_GULP_LATENCY    seconds to sleep before answering (default 0)
+    FITPOT_FAKE_GULP_JITTER     up to this many more seconds, at random
+    FITPOT_FAKE_GULP_FAILURE    share of runs which exit without writing any
+                                output, as a crashed GULP would (default 0)
+
+Point fitpot at it with FITPOT_GULP_CMD=/path/to/fake_gulp.py, set before
+fitpot is imported.
+'''
+
+def structures(text):
+    '''The number of cores of every structure in a GULP input.'''
+    counts = []
+    reading = False
+    for line in text.split('\n'):
+        words = line.split()
+        if not words:
+            continue
+        if words[0] == 'vectors':
+            counts.append(0)
+            reading = False
+        elif words[0] == 'fractional':
+            reading = True
+        elif words[0] == 'species':
+            reading = False
+        elif reading and len(words) > 1 and words[1] == 'core':
+            counts[-1] += 1
+    return counts
+
+def frc(counts, rng):
+    lines = []
+    for n in counts:
+        lines.append('  energy %16.6f eV' % (-3.0*n*(1 + 0.1*rng.random())))
+        lines.append('  gradients cartesian eV/Ang')
+        for i in range(n):
+            lines.append('%6d %16.6f %16.6f %16.6f' % ((i+1,) +
+                tuple( rng.uniform(-1, 1) for j in range(3) )))
+        lines.append('  strain')
+        for i in range(2):
+            lines.append('%16.6f %16.6f %16.6f' % tuple( rng.uniform(-1, 1)
+                for j in range(3) ))
+    return '\n'.join(lines) + '\n'
+
+def main():
+    text = sys.stdin.read()
+    target = None
+    lines = []
+    for line in text.split('\n'):
+        if line.startswith('output frc'):
+            target = line.split()[2]
+        else:
+            lines.append(line)
+    if target is None:
+        sys.exit(1)
+
+    latency = float(os.environ.get('FITPOT_FAKE_GULP_LATENCY', 0))
+    latency += random.random()*float(os.environ.get('FITPOT_FAKE_GULP_JITTER', 0))
+    if latency:
+        time.sleep(latency)
+    if random.random() < float(os.environ.get('FITPOT_FAKE_GULP_FAILURE', 0)):
+        sys.exit(1)
+
+    ## seeded from the input without the (per-worker) output path
+    seed = zlib.crc32('\n'.join(lines).encode('utf-8')) & 0xffffffff
+    rng = random.Random(seed)
+    with open(target, 'w') as f:
+        f.write(frc(structures(text), rng))
+
+if __name__ == '__main__':
+    main()
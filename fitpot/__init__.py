@@ -1,3 +1,3 @@
 from optimizer import Optimizer
-from data import Data
+from data import Data, DataSet
 from genome import Genome
@@ -1,6 +1,8 @@
 import numpy as np
 import matplotlib.pylab as plt
 from collections import defaultdict
+from config import WEIGHTS
+from runlog import MAGIC, read_log
 
 def gene_plot(pfile):
     data = get_data(pfile)
@@ -9,11 +11,51 @@ def gene_plot(pfile):
         plt.show()
 
 def get_data(pfile):
+    '''
+    Returns the genes logged in pfile, one row per gene. Reads both binary run
+    logs and the csv logs of older versions.
+    '''
     f = open(pfile)
+    if f.read(len(MAGIC)) == MAGIC:
+        f.close()
+        log = read_log(pfile)
+        return np.array([ log[k] for k in log.dtype.names[7:] ], dtype=float)
+    f.seek(0)
     data = [ [ float(ff) for ff in d.split(',') ] for d in f.readlines() ]
     data = np.array(data)
     return data.T
 
+def convergence(log, weights=None):
+    '''
+    Returns the generations in a run log (a filename or read_log array) with
+    the best and mean weighted error of each: the logged errors summed with
+    the fit weights (by default, config.WEIGHTS, the Optimizer's), as
+    Optimizer.weighted_error. The logged fitness is relative to the rest of
+    its generation, so it can't be compared across generations.
+    '''
+    if isinstance(log, basestring):
+        log = read_log(log)
+    if weights is None:
+        weights = WEIGHTS
+    gens, starts = np.unique(log['generation'], return_index=True)
+    error = (weights['energy']*np.asarray(log['energy_err']) +
+            weights['stress']*np.asarray(log['stress_err']) +
+            weights['force']*np.asarray(log['force_err']))
+    error = np.where(np.isfinite(error), error, np.nan)
+    best = np.fmin.reduceat(error, starts)
+    total = np.add.reduceat(np.nan_to_num(error), starts)
+    count = np.add.reduceat(np.isfinite(error).astype(int), starts)
+    return gens, best, total/np.maximum(count, 1)
+
+def convergence_plot(pfile, weights=None):
+    gens, best, mean = convergence(pfile, weights)
+    plt.semilogy(gens, best, label='best')
+    plt.semilogy(gens, mean, label='mean')
+    plt.xlabel('generation')
+    plt.ylabel('weighted error')
+    plt.legend()
+    plt.show()
+
 #### intended for use within optimizer
 
 def data_at_extremum(data):
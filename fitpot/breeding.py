@@ -0,0 +1,64 @@
+import numpy as np
+
+__doc__='''
+Breeding of whole generations at once.
+
+Genes are handled as matrices, one row per organism: an (organisms x genes)
+float array of continuous genes, and an object array of discrete genes. Every
+step (tournament selection, blend crossover, mutation) draws from the given
+numpy RandomState, so a generation is reproducible from its seed.
+
+Continuous gene bounds are given as an (genes x 2) array of [low, high] rows,
+discrete gene values as a list of the allowed values of each discrete gene,
+both in the column order of the gene matrices.
+'''
+
+def _choose(rng, values, shape):
+    choices = np.empty(len(values), dtype=object)
+    choices[:] = values
+    return choices[rng.randint(len(values), size=shape)]
+
+def random_genes(rng, n, bounds, values):
+    '''Genes of n random organisms.'''
+    bounds = np.asarray(bounds, dtype=float).reshape(-1, 2)
+    cont = rng.uniform(bounds[:,0], bounds[:,1], (n, len(bounds)))
+    disc = np.empty((n, len(values)), dtype=object)
+    for j, vals in enumerate(values):
+        disc[:,j] = _choose(rng, vals, n)
+    return cont, disc
+
+def tournament(rng, n_ranked, n, size):
+    '''
+    Winners (as ranks) of n tournaments between size organisms of a ranked
+    generation of n_ranked, drawn with replacement.
+    '''
+    return rng.randint(n_ranked, size=(n, size)).min(axis=1)
+
+def crossover(rng, cont1, disc1, cont2, disc2):
+    '''
+    Blends every continuous gene of two sets of parents at a random fraction,
+    and takes every discrete gene from either parent with equal odds.
+    '''
+    frac = rng.rand(*cont1.shape)
+    cont = frac*cont1 + (1-frac)*cont2
+    disc = np.where(rng.rand(*disc1.shape) < 0.5, disc1, disc2)
+    return cont, disc
+
+def mutate(rng, cont, disc, p_mutate, bounds, values):
+    '''Redraws every gene with probability p_mutate.'''
+    fresh_cont, fresh_disc = random_genes(rng, len(cont), bounds, values)
+    cont = np.where(rng.rand(*cont.shape) < p_mutate, fresh_cont, cont)
+    disc = np.where(rng.rand(*disc.shape) < p_mutate, fresh_disc, disc)
+    return cont, disc
+
+def breed(rng, cont, disc, n, tourn_size, p_mutate, bounds, values):
+    '''
+    Genes of n children of the parents whose genes are cont and disc, ranked
+    best first: both parents of each child are tournament winners, and the
+    child is their crossover, mutated.
+    '''
+    first = tournament(rng, len(cont), n, tourn_size)
+    second = tournament(rng, len(cont), n, tourn_size)
+    cont, disc = crossover(rng, cont[first], disc[first],
+            cont[second], disc[second])
+    return mutate(rng, cont, disc, p_mutate, bounds, values)
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+
+__doc__='''
+Memoization of evaluation results.
+
+Results are keyed on (Genome.fingerprint, Data.id), so organisms carried over
+between generations, or which happen to draw identical genes, are only ever
+evaluated once. Failed evaluations are cached as False.
+'''
+
+class ResultCache(object):
+    '''
+    Least-recently-used cache of evaluation results, holding at most `size`
+    entries (a size of 0 disables caching).
+    '''
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._store = OrderedDict()
+
+    def __len__(self):
+        return len(self._store)
+
+    def __contains__(self, key):
+        return key in self._store
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return float(self.hits)/total
+
+    def get(self, key):
+        '''Returns the cached result for key, or None if it isn't cached.'''
+        try:
+            value = self._store.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._store[key] = value
+        self.hits += 1
+        return value
+
+    def peek(self, key):
+        '''Returns the cached result for key, without counting it as a use.'''
+        return self._store.get(key)
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self._store.pop(key, None)
+        self._store[key] = value
+        while len(self._store) > self.size:
+            self._store.popitem(last=False)
+
+    def clear(self):
+        self._store.clear()
+        self.hits = 0
+        self.misses = 0
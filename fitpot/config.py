@@ -1,2 +1,8 @@
-GULP_CMD = '/projects/b1004/bin/gulp40'
+import os
+
+GULP_CMD = os.environ.get('FITPOT_GULP_CMD', '/projects/b1004/bin/gulp40')
 GULP_LIB = '/usr/loca/gulp/gulp40/Libraries'
+SCRATCH_DIR = '/dev/shm'
+CACHE_DIR = os.path.expanduser('~/.fitpot/cache')
+AUTHKEY = os.environ.get('FITPOT_AUTHKEY')
+WEIGHTS = {'energy':10.0, 'stress':1.0, 'force':1.0}
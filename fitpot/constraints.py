@@ -0,0 +1,128 @@
+import numpy as np
+
+__doc__='''
+Constraints checked on whole batches of candidate genes.
+
+A genome's constraints are callables taking an organism and returning
+whether it is acceptable. feasible evaluates them on a batch of candidates at
+once: each constraint is called a single time with a stand-in organism whose
+genes are whole columns (numpy arrays), so constraints written as array
+expressions, e.g.
+
+    lambda x: x.genes['lennard'] != x.genes['eam']
+    lambda x: x.genes['r_0'] < x.genes['r_1']
+
+are vectorized as they are. Constraints which don't give back one boolean per
+candidate (ones using `and`, `if`, ...) are called on an organism made for
+each candidate instead.
+
+The constraint classes below are vectorized by construction. Bound also
+narrows the range a continuous gene is drawn from (see ranges), so values
+it rules out are never sampled in the first place.
+'''
+
+class Constraint(object):
+    '''Base class: subclasses implement batch(genes), genes a dict of arrays.'''
+
+    def __call__(self, org):
+        return bool(self.batch(org.genes))
+
+    def batch(self, genes):
+        raise NotImplementedError
+
+    def narrow(self, ranges):
+        '''Narrows the {gene: [low, high]} sampling ranges, in place.'''
+        pass
+
+class Bound(Constraint):
+    '''low <= gene <= high (either may be None).'''
+
+    def __init__(self, name, low=None, high=None):
+        self.name = name
+        self.low = low
+        self.high = high
+
+    def batch(self, genes):
+        values = np.asarray(genes[self.name])
+        ok = np.ones(values.shape, dtype=bool)
+        if self.low is not None:
+            ok &= values >= self.low
+        if self.high is not None:
+            ok &= values <= self.high
+        return ok
+
+    def narrow(self, ranges):
+        if self.name not in ranges:
+            return
+        low, high = ranges[self.name]
+        if self.low is not None:
+            low = max(low, self.low)
+        if self.high is not None:
+            high = min(high, self.high)
+        ranges[self.name] = [low, high]
+
+class LessThan(Constraint):
+    '''gene a < gene b.'''
+
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+
+    def batch(self, genes):
+        return np.asarray(genes[self.a]) < np.asarray(genes[self.b])
+
+class NotEqual(Constraint):
+    '''gene a != gene b, e.g. two toggles which can't both be on (or off).'''
+
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+
+    def batch(self, genes):
+        return np.asarray(genes[self.a] != genes[self.b], dtype=bool)
+
+class _Candidates(object):
+    '''Stand-in organism whose genes are columns of candidates.'''
+    def __init__(self, genes):
+        self.genes = genes
+
+def ranges(genome):
+    '''
+    The ranges to draw continuous genes from: cont_vars, narrowed by the
+    genome's Bound constraints.
+    '''
+    bounds = dict( (k, list(v)) for k, v in genome.cont_vars.items() )
+    for constraint in genome.constraints:
+        if isinstance(constraint, Constraint):
+            constraint.narrow(bounds)
+    return bounds
+
+def feasible(genome, genes, n):
+    '''
+    Which of n candidates, whose genes are given as {name: array}, satisfy
+    all of the genome's constraints (a boolean array).
+    '''
+    keys = (genome.cont_vars.keys() + genome.functions.keys() +
+            genome.disc_vars.keys() + genome.constants.keys())
+    if len(set(keys)) != len(keys):
+        return np.zeros(n, dtype=bool)
+
+    ok = np.ones(n, dtype=bool)
+    for constraint in genome.constraints:
+        if not ok.any():
+            break
+        if isinstance(constraint, Constraint):
+            ok &= constraint.batch(genes)
+            continue
+        try:
+            result = np.asarray(constraint(_Candidates(genes)))
+        except Exception:
+            result = None
+        if result is not None and result.shape == (n,):
+            ok &= result.astype(bool)
+            continue
+        for i in np.flatnonzero(ok):
+            org = genome.restore({'genes':
+                dict( (k, v[i]) for k, v in genes.items() )})
+            ok[i] = bool(constraint(org))
+    return ok
@@ -1,6 +1,11 @@
 import numpy as np
 from numpy.linalg import inv
+import hashlib
+import json
+import multiprocessing as mp
 import os, os.path
+import tempfile
+from config import *
 
 ### IPR specific stuff ###
 class FortranError(Exception):
@@ -18,6 +23,158 @@ class DataError(Exception):
 
 ### IPR specific stuff ###
 
+def stack_data(datas):
+    '''
+    Packs the reference outputs of a list of Data objects into contiguous
+    arrays:
+        energy      = (n_data,)
+        stresses    = (n_data, 6)
+        forces      = (n_atoms, 3), every snapshot's forces back to back
+        offsets     = (n_data+1,), forces[offsets[i]:offsets[i+1]] belong to
+                        datas[i]
+    '''
+    counts = [ len(d.forces) for d in datas ]
+    return {'energy': np.array([ d.energy for d in datas ], dtype=float),
+            'stresses': np.array([ d.stresses for d in datas ], dtype=float),
+            'forces': np.concatenate([ np.asarray(d.forces, dtype=float)
+                for d in datas ]).reshape(-1, 3),
+            'offsets': np.concatenate([[0], np.cumsum(counts)])}
+
+def pack_data(datas):
+    '''
+    Packs a list of Data objects into arrays: those of stack_data, plus
+        cells       = (n_data, 3, 3)
+        coords      = (n_atoms, 3), fractional coordinates
+        species     = (n_atoms,)
+    '''
+    if isinstance(datas, DataSet):
+        return datas.pack()
+    arrays = stack_data(datas)
+    arrays['cells'] = np.array([ d.cell for d in datas ],
+            dtype=float).reshape(-1, 3, 3)
+    arrays['coords'] = np.array([ atom[1] for d in datas
+        for atom in d.coords ], dtype=float).reshape(-1, 3)
+    arrays['species'] = np.array([ atom[0] for d in datas
+        for atom in d.coords ], dtype=str)
+    return arrays
+
+def unpack_data(arrays):
+    '''Inverse of pack_data.'''
+    datas = []
+    offsets = arrays['offsets']
+    for i in range(len(arrays['energy'])):
+        start, end = offsets[i], offsets[i+1]
+        snapshot = Data()
+        snapshot.energy = float(arrays['energy'][i])
+        snapshot.stresses = arrays['stresses'][i]
+        snapshot.cell = arrays['cells'][i]
+        snapshot.forces = arrays['forces'][start:end]
+        snapshot.coords = zip(arrays['species'][start:end],
+                arrays['coords'][start:end])
+        datas.append(snapshot)
+    return datas
+
+### ingestion cache ###
+
+def _signature(source, selection):
+    '''
+    Identifies the current contents of an OUTCAR or snapshot directory by
+    the path, size and modification time of the files read from it.
+    '''
+    kind, path = source
+    if kind == 'outcar':
+        files = [path]
+    else:
+        files = [ os.path.join(path, f) for f in os.listdir(path) ]
+    stats = [ (f, os.path.getsize(f), os.path.getmtime(f))
+            for f in sorted(files) if os.path.isfile(f) ]
+    return json.dumps([os.path.abspath(path), selection, stats])
+
+def _cache_file(source, cache_dir):
+    key = hashlib.sha1(os.path.abspath(source[1])).hexdigest()
+    return os.path.join(cache_dir, key+'.npz')
+
+def _read_source(bundle):
+    '''
+    Parses one OUTCAR or snapshot directory, writing the packed result to the
+    cache (if given). Returns the packed arrays.
+    '''
+    source, selection, cache_dir = bundle
+    kind, path = source
+    signature = _signature(source, selection)
+    if kind == 'outcar':
+        datas = Data.read_outcar(path, *selection)
+    else:
+        datas = [Data.read_snapshot(path)]
+    if not datas:
+        return None
+    arrays = pack_data(datas)
+    if cache_dir:
+        target = _cache_file(source, cache_dir)
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, signature=signature, **arrays)
+        os.rename(tmp, target)
+    return arrays
+
+def _read_cache(source, selection, cache_dir):
+    '''Returns the cached arrays for source, or None if out of date.'''
+    if not cache_dir:
+        return None
+    target = _cache_file(source, cache_dir)
+    if not os.path.exists(target):
+        return None
+    try:
+        cached = np.load(target)
+        if str(cached['signature']) != _signature(source, selection):
+            return None
+        return dict( (k, cached[k]) for k in cached.files
+                if k != 'signature' )
+    except (IOError, ValueError, KeyError):
+        return None
+
+def read_arrays(search_path, start=0, stop=None, stride=1,
+        processes=None, cache_dir=CACHE_DIR):
+    '''
+    Reads every OUTCAR and snapshot directory below search_path, returning the
+    packed arrays (see pack_data) of each. start, stop and stride select which
+    ionic steps of each OUTCAR are read (see Data.iter_outcar).
+
+    Files are parsed in parallel over a pool of `processes` workers, and the
+    parsed arrays are cached in cache_dir (one .npz per source), keyed on
+    path, size and mtime, so that unchanged files are never parsed twice. A
+    cache_dir of None disables the cache.
+    '''
+    sources = []
+    for (path, dirs, files) in os.walk(search_path):
+        for file in files:
+            if 'OUTCAR' in file:
+                sources.append(('outcar', path+'/'+file))
+        if set(['energy', 'stresses', 'forces', 'POSCAR']) < set(files):
+            sources.append(('snapshot', path))
+
+    selection = [start, stop, stride]
+    if cache_dir and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    arrays = [ _read_cache(source, selection, cache_dir)
+            for source in sources ]
+    todo = [ (source, selection, cache_dir)
+            for source, a in zip(sources, arrays) if a is None ]
+    if len(todo) > 1:
+        pool = mp.Pool(processes)
+        try:
+            parsed = pool.map_async(_read_source, todo).get(1e7)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        parsed = map(_read_source, todo)
+    parsed = iter(parsed)
+    arrays = [ next(parsed) if a is None else a for a in arrays ]
+    return [ a for a in arrays if a is not None ]
+
+### ingestion cache ###
+
 class Data:
     def __init__(self):
         '''
@@ -33,19 +190,22 @@ class Data:
         '''
         self.cell = [[]]
         self.atoms = []
+        self.coords = []
         self.energy = 0.0
         self.stresses = [0,0,0,0,0,0]
         self.forces = [[]]
 
     @staticmethod
-    def read_path(search_path):
+    def read_path(search_path, start=0, stop=None, stride=1,
+            processes=None, cache_dir=CACHE_DIR):
+        '''
+        Reads every OUTCAR and snapshot directory below search_path (see
+        read_arrays).
+        '''
         data = []
-        for (path, dirs, files) in os.walk(search_path):
-            for file in files:
-                if 'OUTCAR' in file:
-                    data += Data.read_outcar(path+'/'+file)
-            if set(['energy', 'stresses', 'forces', 'POSCAR']) < set(files):
-                data.append(Data.read_snapshot(path))
+        for arrays in read_arrays(search_path, start, stop, stride,
+                processes, cache_dir):
+            data += unpack_data(arrays)
         return data
 
     @property
@@ -120,55 +280,268 @@ class Data:
         return snapshot
 
     @staticmethod
-    def read_outcar(outcar):
-        data = open(outcar).readlines()
-        snapshots = []
-        atom_types = []
-        atom_counts = []
-        atom_array = []
+    def read_outcar(outcar, start=0, stop=None, stride=1):
+        return list(Data.iter_outcar(outcar, start, stop, stride))
 
-        snapshot = Data()
+    @staticmethod
+    def iter_outcar(outcar, start=0, stop=None, stride=1):
+        '''
+        Reads an OUTCAR one line at a time, yielding a Data object per ionic
+        step. Only steps start, start+stride, ... (up to, but not including,
+        stop) are yielded, and reading stops as soon as stop is reached.
+        '''
+        with open(outcar) as lines:
+            atom_types = []
+            atom_counts = []
+            atom_array = []
+            inv_cell = None
+            step = 0
+
+            snapshot = Data()
 
-        for n,line in enumerate(data):
-            if 'POTCAR:' in line:
-                temp = line.split()[2]
-                for c in ['.','_','1']:
-                    if c in temp:
-                        temp = temp[0:temp.find(c)]
-                atom_types += [temp]
-            if 'ions per type' in line:
-                atom_types = atom_types[:len(atom_types)/2]
-                atom_counts = [ int(f) for f in line.split()[4:] ]
-                for type, count in zip(atom_types, atom_counts):
-                    atom_array += [type]*count
-            if 'direct lattice vectors' in line:
-                cell = []
-                for i in range(3):
-                    temp = data[n+1+i].split()
-                    cell += [[float(temp[0]), float(temp[1]), float(temp[2])]]
-                inv_cell = inv(cell)
-                snapshot.cell = cell
-            if 'FREE ENERGIE OF THE ION-ELECTRON SYSTEM' in line:
-                snapshot.energy = float(data[n+4].split()[6])
-            if 'STRESS in cart' in line:
-                for iline in range(20):
-                    nline = data[n+iline]
-                    if 'Total' in nline:
-                        snapshot.stresses = [ float(f) for f in 
-                                nline.split()[1:]]
+            for line in lines:
+                if 'POTCAR:' in line:
+                    temp = line.split()[2]
+                    for c in ['.','_','1']:
+                        if c in temp:
+                            temp = temp[0:temp.find(c)]
+                    atom_types += [temp]
+                elif 'ions per type' in line:
+                    atom_types = atom_types[:len(atom_types)/2]
+                    atom_counts = [ int(f) for f in line.split()[4:] ]
+                    for type, count in zip(atom_types, atom_counts):
+                        atom_array += [type]*count
+                elif 'direct lattice vectors' in line:
+                    cell = [ [ float(v) for v in next(lines).split()[:3] ]
+                            for i in range(3) ]
+                    inv_cell = inv(cell)
+                    snapshot.cell = cell
+                elif 'FREE ENERGIE OF THE ION-ELECTRON SYSTEM' in line:
+                    for i in range(4):
+                        nline = next(lines)
+                    snapshot.energy = float(nline.split()[6])
+                elif 'STRESS in cart' in line:
+                    nline = line
+                    for iline in range(20):
+                        if 'Total' in nline:
+                            snapshot.stresses = [ float(f) for f in 
+                                    nline.split()[1:]]
+                            break
+                        nline = next(lines)
+                elif 'POSITION          ' in line:
+                    if stop is not None and step >= stop:
                         break
-            if 'POSITION          ' in line:
-                forces = []
-                atoms = []
-                for iatom, elt in enumerate(atom_array):
-                    temp = data[n+2+iatom].split()
-                    forces += [[float(f) for f in temp[3:6]]]
-                    atoms += [(elt, 
-                        np.dot(inv_cell, [float(f) for f in temp[0:3]])
-                        )]
-                snapshot.forces = forces
-                snapshot.coords = atoms
-                snapshots.append(snapshot)
-                snapshot = Data()
-        return snapshots
+                    next(lines)
+                    block = [ next(lines) for elt in atom_array ]
+                    if step >= start and (step-start) % stride == 0:
+                        block = np.array([ l.split()[:6] for l in block ],
+                                dtype=float).reshape(-1, 6)
+                        snapshot.forces = block[:,3:6]
+                        snapshot.coords = zip(atom_array,
+                                np.dot(block[:,0:3], inv_cell))
+                        yield snapshot
+                    step += 1
+                    snapshot = Data()
+
+
+class DataSet(object):
+    '''
+    Structure-of-arrays container for a set of snapshots.
+
+        ids         = (n_data,)
+        energy      = (n_data,)
+        stresses    = (n_data, 6)
+        cells       = (n_data, 3, 3)
+        offsets     = (n_data+1,), the atoms of the i'th snapshot are rows
+                        offsets[i]:offsets[i+1] of the per-atom arrays
+        coords      = (n_atoms, 3), fractional coordinates
+        forces      = (n_atoms, 3)
+        species     = (n_atoms,), indices into species_table
+
+    A DataSet behaves like a dict of Data objects keyed on snapshot id: it
+    returns DataViews, which can be used anywhere a Data object is read.
+    '''
+
+    def __init__(self, datas=None):
+        self.ids = np.zeros(0, dtype=int)
+        self.energy = np.zeros(0)
+        self.stresses = np.zeros((0, 6))
+        self.cells = np.zeros((0, 3, 3))
+        self.offsets = np.zeros(1, dtype=int)
+        self.coords = np.zeros((0, 3))
+        self.forces = np.zeros((0, 3))
+        self.species = np.zeros(0, dtype=np.int16)
+        self.species_table = []
+        self._rows = {}
+        if datas is not None:
+            self.extend(datas)
+
+    @staticmethod
+    def read_path(search_path, start=0, stop=None, stride=1,
+            processes=None, cache_dir=CACHE_DIR):
+        '''
+        Reads every OUTCAR and snapshot directory below search_path into a
+        DataSet, without creating a Data object per snapshot (see
+        read_arrays).
+        '''
+        return DataSet(read_arrays(search_path, start, stop, stride,
+                processes, cache_dir))
+
+    def extend(self, datas, ids=None):
+        '''
+        Appends snapshots, given as Data objects, as arrays from pack_data, or
+        as a list of the latter. New snapshots take the next free ids, unless
+        ids are given.
+        '''
+        if isinstance(datas, dict):
+            parts = [datas]
+        else:
+            datas = list(datas)
+            if datas and isinstance(datas[0], dict):
+                parts = datas
+            elif datas:
+                parts = [pack_data(datas)]
+            else:
+                parts = []
+        if not parts:
+            return
+
+        lookup = dict( (s, i) for i, s in enumerate(self.species_table) )
+        species = []
+        for part in parts:
+            for s in part['species']:
+                if s not in lookup:
+                    lookup[s] = len(self.species_table)
+                    self.species_table.append(str(s))
+            species.append(np.array([ lookup[s] for s in part['species'] ],
+                dtype=np.int16))
+
+        n_old = len(self.ids)
+        offsets = [self.offsets]
+        for part in parts:
+            offsets.append(part['offsets'][1:] + offsets[-1][-1])
+        count = sum( len(part['energy']) for part in parts )
+        if ids is None:
+            start = self.ids.max()+1 if n_old else 0
+            ids = np.arange(start, start+count)
+
+        self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=int)])
+        self.offsets = np.concatenate(offsets)
+        self.species = np.concatenate([self.species] + species)
+        for name in ['energy', 'stresses', 'cells', 'coords', 'forces']:
+            setattr(self, name, np.concatenate([getattr(self, name)] +
+                [ np.asarray(part[name], dtype=float).reshape(
+                    (-1,) + getattr(self, name).shape[1:])
+                    for part in parts ]))
+        for row in range(n_old, len(self.ids)):
+            self._rows[int(self.ids[row])] = row
 
+    def _gather(self, rows):
+        '''Returns the per-atom row indices and offsets of rows.'''
+        starts = self.offsets[rows]
+        counts = self.offsets[np.asarray(rows)+1] - starts
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        atoms = (np.repeat(starts - offsets[:-1], counts) +
+                np.arange(offsets[-1]))
+        return atoms, offsets
+
+    def stack(self, ids):
+        '''stack_data for the snapshots ids, by indexing into the arrays'''
+        rows = [ self._rows[d] for d in ids ]
+        atoms, offsets = self._gather(rows)
+        return {'energy': self.energy[rows],
+                'stresses': self.stresses[rows],
+                'forces': self.forces[atoms],
+                'offsets': offsets}
+
+    def pack(self, ids=None):
+        '''pack_data for the snapshots ids (by default all of them)'''
+        if ids is None:
+            ids = self.ids
+        rows = [ self._rows[d] for d in ids ]
+        atoms, offsets = self._gather(rows)
+        arrays = self.stack(ids)
+        arrays['ids'] = self.ids[rows]
+        arrays['cells'] = self.cells[rows]
+        arrays['coords'] = self.coords[atoms]
+        arrays['species'] = np.array(self.species_table,
+                dtype=str)[self.species[atoms]]
+        return arrays
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, data_id):
+        return data_id in self._rows
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, data_id):
+        return DataView(self, self._rows[data_id])
+
+    def __setitem__(self, data_id, data):
+        if data_id in self._rows:
+            raise KeyError('snapshot %s already in DataSet' % data_id)
+        self.extend([data], ids=[data_id])
+
+    def keys(self):
+        return [ int(d) for d in self.ids ]
+
+    def values(self):
+        return [ DataView(self, row) for row in range(len(self.ids)) ]
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+
+class DataView(object):
+    '''Read-only Data-like view of one snapshot of a DataSet'''
+    __slots__ = ['dataset', 'row']
+
+    def __init__(self, dataset, row):
+        self.dataset = dataset
+        self.row = row
+
+    @property
+    def id(self):
+        return int(self.dataset.ids[self.row])
+
+    @property
+    def energy(self):
+        return float(self.dataset.energy[self.row])
+
+    @property
+    def stresses(self):
+        return self.dataset.stresses[self.row]
+
+    @property
+    def cell(self):
+        return self.dataset.cells[self.row]
+
+    @property
+    def _atoms(self):
+        return slice(self.dataset.offsets[self.row],
+                self.dataset.offsets[self.row+1])
+
+    @property
+    def forces(self):
+        return self.dataset.forces[self._atoms]
+
+    @property
+    def coords(self):
+        atoms = self._atoms
+        table = self.dataset.species_table
+        return zip([ table[s] for s in self.dataset.species[atoms] ],
+                self.dataset.coords[atoms])
+
+    @property
+    def inputs(self):
+        return {'cell':self.cell, 
+                'atoms':self.coords}
+
+    @property
+    def outputs(self):
+        return {'energy': self.energy,
+                'forces': self.forces,
+                'stresses': self.stresses}
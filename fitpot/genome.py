@@ -1,11 +1,73 @@
 from utils import *
+import hashlib
 import json
 import os
 import random
 import subprocess
 import tempfile
+import types
 import random
 from numpy import linspace
+from constraints import ranges
+
+GULP_HEADER = 'conp gradient\ntitle\nIPR generated gulp input\nend\n'
+
+## the last potential wrapped, as (pot_string, block)
+_last_potential = (None, None)
+
+def wrap_lines(text):
+    '''Continues every line of text longer than GULP allows.'''
+    return '\n'.join( ensure_length(line) for line in text.split('\n') )
+
+def structure_block(snapshot, shells=False):
+    '''
+    The GULP configuration block (cell and fractional coordinates) of a Data
+    object, ready to be joined into an input. It is rendered once and kept on
+    the snapshot, where the snapshot allows it.
+    '''
+    blocks = getattr(snapshot, '_gulp_blocks', None)
+    if blocks is not None and shells in blocks:
+        return blocks[shells]
+    lines = ['vectors']
+    for line in snapshot.cell:
+        lines.append('%0.8f %0.8f %0.8f' % tuple(line))
+    lines.append('0 0 0 0 0 0')
+    lines.append('fractional')
+    for atom in snapshot.coords:
+        lines.append('%s core %0.8f %0.8f %0.8f 1 0 0 0' % (
+            (atom[0],) + tuple(atom[1])))
+        if shells:
+            lines.append('%s shell %0.8f %0.8f %0.8f 1 1 1 1' % (
+                (atom[0],) + tuple(atom[1])))
+    block = wrap_lines('\n'.join(lines)) + '\n'
+    try:
+        if blocks is None:
+            blocks = snapshot._gulp_blocks = {}
+        blocks[shells] = block
+    except AttributeError:
+        pass
+    return block
+
+def potential_block(pot_string):
+    '''
+    The rendered potential, wrapped for GULP. The last one is remembered, as
+    an organism's potential is usually needed for several snapshots in a row.
+    '''
+    global _last_potential
+    if _last_potential[0] != pot_string:
+        _last_potential = (pot_string, wrap_lines(pot_string))
+    return _last_potential[1]
+
+def gulp_input(data, pot_string, shells=False):
+    '''
+    Renders a GULP input for a Data object (or a list of them) and a rendered
+    potential block, by joining their pre-rendered blocks.
+    '''
+    if not isinstance(data, (list, tuple)):
+        data = [data]
+    return (GULP_HEADER +
+            ''.join( structure_block(snapshot, shells) for snapshot in data ) +
+            potential_block(pot_string))
 
 class Genome:
     cont_vars = {}
@@ -13,6 +75,8 @@ class Genome:
     disc_vars = {}
     constraints = []
     constants = {}
+    fields = []
+    species = {}
 
     def __init__(self):
         self.genes = {}
@@ -21,6 +85,19 @@ class Genome:
         while not self.valid:
             self.randomize()
 
+    @classmethod
+    def restore(cls, state):
+        '''
+        Recreates an organism from its saved attributes (a checkpointed
+        __dict__), without drawing new genes.
+        '''
+        if isinstance(cls, type):
+            org = object.__new__(cls)
+        else:
+            org = types.InstanceType(cls)
+        org.__dict__.update(state)
+        return org
+
     @property
     def generator_string(self):
         raise NotImplementedError
@@ -39,6 +116,11 @@ class Genome:
                 values[k] = v[1]
         return values
 
+    @property
+    def fingerprint(self):
+        '''Hash of the potential parameters, used as an evaluation cache key'''
+        return hashlib.sha1(repr(sorted(self.values.items()))).hexdigest()
+
     @property
     def valid(self):
         keys = self.cont_vars.keys() 
@@ -50,9 +132,9 @@ class Genome:
         return all( constraint(self) for constraint in self.constraints )
 
     def randomize(self):
-        for k, vals in self.cont_vars.items():
-            self.genes[k] = random.choice(
-                    linspace(self.cont_vars[k][0], self.cont_vars[k][1], 1e3))
+        bounds = ranges(self)
+        for k, vals in bounds.items():
+            self.genes[k] = random.choice(linspace(vals[0], vals[1], 1e3))
         for k in self.disc_vars:
             self.genes[k] = random.choice(self.disc_vars[k])
 
@@ -80,26 +162,12 @@ class Genome:
                 **self.values)
 
     def gulp(self, data):
-        gulp_instr = 'conp gradient\n'
-        gulp_instr += 'title\nIPR generated gulp input\nend\n'
-        gulp_instr += 'vectors\n'
-        for line in data.cell:
-            gulp_instr += '%0.8f %0.8f %0.8f\n' % tuple(line)
-        gulp_instr += '0 0 0 0 0 0\n'
-        gulp_instr += 'fractional\n'
-        for atom in data.coords:
-            gulp_instr += '%s core %0.8f %0.8f %0.8f 1 0 0 0\n' % (
-                    (atom[0],) + tuple(atom[1]))
-            if 'shellmode' in self.constants:
-                gulp_instr += '%s shell %0.8f %0.8f %0.8f 1 1 1 1\n' % (
-                    (atom[0],) + tuple(atom[1]))
-        gulp_instr += self.pot_string
-
-        gulp_list = gulp_instr.split('\n')
-        safe_gulp_list = []
-        for line in gulp_list:
-            safe_gulp_list.append(ensure_length(line))
-        return '\n'.join(safe_gulp_list)
+        '''
+        Renders the GULP input for a Data object. If given a list of Data
+        objects, every structure is written as its own configuration, followed
+        by a single copy of the potential.
+        '''
+        return gulp_input(data, self.pot_string, 'shellmode' in self.constants)
 
     def save(self, filename):
         f = open(filename,'w')
@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+
+__doc__='''
+Counters and timers for the phases of a run.
+
+A Profiler times phases (`with profiler.phase('fitness'): ...`), counts
+things (`profiler.count('failures')`), and takes timings measured elsewhere,
+e.g. the per-evaluation timings workers send back with their results
+(record). When disabled, phase returns a shared do-nothing context and the
+other calls return straight away.
+
+Totals accumulate until summary is taken (the Optimizer does so once per
+generation, and appends them to its profile_file). With trace on, every timed
+span is also kept as a Chrome trace event (write_trace; open the file in
+chrome://tracing or Perfetto). Hooks added with subscribe are called with
+every event as it is recorded.
+
+Evaluation timings, as returned by gulp_call and native_call after the
+result, are dicts of the worker's pid, the start time, and the seconds spent
+in each step (render, gulp, parse; or native).
+'''
+
+class _Null(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL = _Null()
+
+class _Span(object):
+    __slots__ = ('profiler', 'name', 'args', 'start')
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.start, time.time()-self.start,
+                self.args)
+        return False
+
+class Profiler(object):
+    '''Collects phase timings and counters; see the module documentation.'''
+
+    def __init__(self, enabled=False, trace=False):
+        self.enabled = enabled
+        self.trace = trace
+        self.events = []
+        self.hooks = []
+        self.reset()
+
+    def reset(self):
+        self.counters = defaultdict(int)
+        self.timers = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    def subscribe(self, hook):
+        '''Calls hook(event) with every event recorded from now on.'''
+        self.hooks.append(hook)
+
+    def phase(self, name, **args):
+        '''Context manager timing its block as the phase name.'''
+        if not self.enabled:
+            return _NULL
+        return _Span(self, name, args)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def record(self, name, start, duration, args=None, pid=None, tid=None):
+        '''Records a span of duration seconds from start (a time.time()).'''
+        if not self.enabled:
+            return
+        self.timers[name] += duration
+        self.calls[name] += 1
+        if not (self.trace or self.hooks):
+            return
+        event = {'name': name, 'ph': 'X', 'ts': start*1e6,
+                'dur': duration*1e6, 'pid': pid or os.getpid(),
+                'tid': tid if tid is not None else threading.current_thread().ident,
+                'args': args or {}}
+        if self.trace:
+            self.events.append(event)
+        for hook in self.hooks:
+            hook(event)
+
+    def record_evaluation(self, times, submitted=None):
+        '''
+        Records the timings of one evaluation (see the module documentation)
+        and, given when it was submitted, how long it waited in the queue.
+        '''
+        if not self.enabled or not times:
+            return
+        start = times['start']
+        if submitted is not None:
+            self.record('queue wait', submitted, max(start-submitted, 0.0),
+                    pid=times['pid'])
+        for step in ['render', 'gulp', 'parse', 'native']:
+            if step in times:
+                self.record(step, start, times[step], pid=times['pid'])
+                start += times[step]
+
+    def summary(self, reset=True):
+        '''The counters and timers accumulated since the last reset.'''
+        summary = {'counters': dict(self.counters),
+                'seconds': dict(self.timers), 'calls': dict(self.calls)}
+        if reset:
+            self.reset()
+        return summary
+
+    def write_trace(self, filename):
+        '''Writes the recorded events as a Chrome trace (JSON) file.'''
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': self.events,
+                'displayTimeUnit': 'ms'}, f)
@@ -0,0 +1,188 @@
+import os
+import random
+import Queue
+import multiprocessing as mp
+import numpy as np
+
+__doc__='''
+Island-model runs.
+
+An Archipelago runs several copies ("islands") of a configured Optimizer,
+each in its own process with its own population, fit set draw, random
+streams, GULP workers, log, checkpoint and profile files (ipr.<i>.log,
+ipr.<i>.chk, best.<i>.pot, ipr.<i>.prof). Islands only synchronize through
+migration: every migrate_every generations, each sends the genes of its best
+`migrants` organisms to its neighbours and takes in whatever has arrived from
+them, in place of its worst organisms. Nobody waits for anybody, so a slow
+island never holds up the others.
+
+Topologies: 'ring' (each island sends to the next), 'complete' (to all
+others), 'random' (to one other, drawn anew each time), or a dict mapping
+each island to the list of islands it sends to.
+
+When every island is done, their final elites are evaluated together on
+the fit set of the optimizer the archipelago was made from, and the best one
+is written to its best_file.
+'''
+
+def neighbours(topology, n, index):
+    '''The islands that island index sends its migrants to.'''
+    if isinstance(topology, dict):
+        return list(topology.get(index, []))
+    if topology == 'ring':
+        return [(index+1) % n] if n > 1 else []
+    if topology in ['complete', 'random']:
+        return [ j for j in range(n) if j != index ]
+    raise ValueError('unknown topology: %s' % topology)
+
+def _numbered(filename, index):
+    root, ext = os.path.splitext(filename)
+    return '%s.%d%s' % (root, index, ext)
+
+class Migration(object):
+    '''
+    Called by an island's Optimizer after each generation is evaluated;
+    exchanges migrants on schedule.
+    '''
+
+    def __init__(self, index, inbox, outboxes, every=5, size=2, pick_one=False):
+        self.index = index
+        self.inbox = inbox
+        self.outboxes = outboxes
+        self.every = every
+        self.size = size
+        self.pick_one = pick_one
+        self.sent = 0
+        self.received = 0
+
+    def __call__(self, optimizer):
+        generation = len(optimizer.generations)-1
+        if not self.every or generation % self.every:
+            return
+        elite = optimizer.organisms.elite(self.size)
+        migrants = (self.index, optimizer.organisms.gene_matrix(elite),
+                optimizer.organisms.disc_matrix(elite))
+        outboxes = self.outboxes
+        if self.pick_one and outboxes:
+            outboxes = [random.choice(outboxes)]
+        for outbox in outboxes:
+            outbox.put(migrants)
+            self.sent += len(elite)
+
+        arrivals = []
+        while True:
+            try:
+                arrivals.append(self.inbox.get_nowait())
+            except Queue.Empty:
+                break
+        if not arrivals:
+            return
+        cont = np.vstack([ a[1] for a in arrivals ])
+        disc = np.vstack([ a[2] for a in arrivals ])
+        org_ids = optimizer.organisms.extend(optimizer.genome, cont, disc)
+        gen = optimizer.generations[-1]
+        optimizer.generations[-1] = gen[:max(len(gen)-len(org_ids), 0)] + org_ids
+        print ' - Island %d: %d migrants in' % (self.index, len(org_ids))
+        ## the rest of the generation has been raced already
+        optimizer.evaluate_next(race=False)
+        self.received += len(org_ids)
+
+def _island(optimizer, index, generations, migration, results, seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    for outbox in migration.outboxes:
+        ## unread migrants must not keep the island from exiting
+        outbox.cancel_join_thread()
+    optimizer.migration = migration
+    optimizer._run(generations)
+    elite = optimizer.organisms.elite(migration.size)
+    results.put((index, optimizer.organisms.gene_matrix(elite),
+        optimizer.organisms.disc_matrix(elite)))
+
+class Archipelago(object):
+    '''
+    Runs `islands` copies of optimizer (configured, with its data and genome
+    loaded) as islands. island_options, if given, is a list of dicts of
+    Optimizer options for each island (e.g. a different p_mutate).
+    '''
+
+    def __init__(self, optimizer, islands=4, migrate_every=5, migrants=2,
+            topology='ring', island_options=None):
+        self.optimizer = optimizer
+        self.islands = islands
+        self.migrate_every = migrate_every
+        self.migrants = migrants
+        self.topology = topology
+        self.island_options = island_options or [{}]*islands
+
+    def __call__(self, generations=300):
+        opt = self.optimizer
+        ## written once here, and read by every island's workers
+        opt.structures
+        processes = opt.processes or mp.cpu_count()
+        inboxes = [ mp.Queue() for i in range(self.islands) ]
+        results = mp.Queue()
+        islands = []
+        for i in range(self.islands):
+            migration = Migration(i, inboxes[i], [ inboxes[j] for j in
+                neighbours(self.topology, self.islands, i) ],
+                self.migrate_every, self.migrants, self.topology == 'random')
+            seed = random.getrandbits(32)
+            islands.append(mp.Process(target=self._start,
+                args=(i, generations, migration, results, seed, processes)))
+        for island in islands:
+            island.start()
+
+        elites = []
+        while len(elites) < self.islands:
+            try:
+                elites.append(results.get(timeout=1.0))
+            except Queue.Empty:
+                failed = [ i for i, island in enumerate(islands)
+                        if island.exitcode not in [None, 0] ]
+                if failed:
+                    for island in islands:
+                        island.terminate()
+                    raise RuntimeError('island(s) %s failed' % failed)
+        for island in islands:
+            island.join()
+        return self.judge(elites)
+
+    def _start(self, index, generations, migration, results, seed, processes):
+        opt = self.optimizer
+        opt.processes = max(1, processes // self.islands)
+        opt.log_file = _numbered(opt.log_file, index)
+        opt.checkpoint_file = _numbered(opt.checkpoint_file, index)
+        opt.best_file = _numbered(opt.best_file, index)
+        opt.profile_file = _numbered(opt.profile_file, index)
+        if opt.trace_file:
+            opt.trace_file = _numbered(opt.trace_file, index)
+        if opt.seed is not None:
+            opt.seed += index
+        for k, v in self.island_options[index].items():
+            setattr(opt, k, v)
+        _island(opt, index, generations, migration, results, seed)
+
+    def judge(self, elites):
+        '''
+        Evaluates the islands' final elites together on the optimizer's fit
+        set, saving and returning the best organism.
+        '''
+        opt = self.optimizer
+        if not opt.fit_set:
+            opt.select_fit_data()
+        elites = sorted(elites)
+        cont = np.vstack([ e[1] for e in elites ])
+        disc = np.vstack([ e[2] for e in elites ])
+        opt.generations = [opt.organisms.extend(opt.genome, cont, disc)]
+        try:
+            opt.evaluate_next(race=False)
+        finally:
+            if opt.pool is not None:
+                opt.pool.close()
+                opt.pool = None
+            if opt.scheduler is not None:
+                opt.scheduler.close()
+                opt.scheduler = None
+        opt.update_best()
+        return opt.best
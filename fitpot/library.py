@@ -53,6 +53,8 @@ class GenomeFactory(object):
                 genome.disc_vars.update(f.disc_vars)
                 genome.constants.update(f.constants)
                 genome.constraints += f.constraints
+        genome.fields = list(self.fields)
+        genome.species = dict(self.species)
         return genome
 
 def genome_factory(cont_vars={},
@@ -0,0 +1,53 @@
+import numpy as np
+
+__doc__='''
+Local refinement of organisms (the "memetic" part of the GA).
+
+pattern_search is a compass search run from several starting points at once:
+every iteration tries a step up and a step down along each continuous gene of
+every point, evaluating all of the trials in a single batch, moves each point
+to its best trial if that improves on it, and otherwise halves its steps.
+Trials are kept within the gene bounds.
+'''
+
+def compass(x, step, bounds):
+    '''
+    The trials around each row of x: returns them (rows of 2*genes trials
+    per point) and the index of the point each one belongs to.
+    '''
+    n, d = x.shape
+    moves = np.vstack([np.diag(step_row) for step_row in step]
+            ).reshape(n, d, d)
+    trials = np.concatenate([x[:,None,:] + moves, x[:,None,:] - moves],
+            axis=1)
+    trials = np.clip(trials, bounds[:,0], bounds[:,1])
+    owners = np.repeat(np.arange(n), 2*d)
+    return trials.reshape(n*2*d, d), owners
+
+def pattern_search(objective, x, step, bounds, iterations=3):
+    '''
+    Refines each row of x, with initial steps `step` (a row per point, or one
+    shared row) within bounds ([low, high] per gene). objective(X, owners)
+    returns the errors of the rows of X (owners: which point each row comes
+    from), lower being better.
+
+    Returns the refined points, their errors, and which of them moved.
+    '''
+    x = np.array(x, dtype=float)
+    bounds = np.asarray(bounds, dtype=float).reshape(-1, 2)
+    step = np.array(np.broadcast_to(step, x.shape), dtype=float)
+    n, d = x.shape
+    errors = objective(x, np.arange(n))
+    moved = np.zeros(n, dtype=bool)
+    if not d:
+        return x, errors, moved
+    for i in range(iterations):
+        trials, owners = compass(x, step, bounds)
+        trial_errors = objective(trials, owners).reshape(n, 2*d)
+        best = trial_errors.argmin(axis=1)
+        better = trial_errors[np.arange(n), best] < errors
+        x[better] = trials.reshape(n, 2*d, d)[better, best[better]]
+        errors[better] = trial_errors[better, best[better]]
+        moved |= better
+        step[~better] *= 0.5
+    return x, errors, moved
@@ -0,0 +1,162 @@
+import os
+import time
+import numpy as np
+from shared import SharedStructures
+
+__doc__='''
+In-process evaluation of pair potentials, bypassing GULP.
+
+Genomes built by a GenomeFactory purely out of fields in the lennard family
+('lennard m n', optionally 'epsilon' or 'zero', e.g. lennard_jones and
+eam_repulsive) between uncharged cores are supported. Each field's line is
+rendered exactly as it would be for GULP and interpreted the same way:
+
+    plain       :   E = A/r^m - B/r^n                 ( A B [rmin] rmax )
+    epsilon     :   E = eps*[c1(sig/r)^m - c2(sig/r)^n] ( eps sig [rmin] rmax )
+    zero        :   E = eps*c*[(sig/r)^m - (sig/r)^n]   ( eps sig [rmin] rmax )
+
+native_call returns results in the same form as read_frcout, i.e. the
+cartesian energy gradients and the strain derivatives (xx yy zz yz xz xy) as
+GULP would write them.
+'''
+
+def _words(line):
+    return ' '.join(line.split())
+
+def supports_native(genome):
+    '''
+    True if every term of genome can be evaluated by native_call: its GULP
+    template holds nothing but the species (uncharged) and lennard fields, as
+    a GenomeFactory renders them. Any other line (keywords, options, cutoffs
+    or terms added to the template by hand) would be ignored natively.
+    '''
+    fields = getattr(genome, 'fields', [])
+    if not fields or 'shellmode' in genome.constants:
+        return False
+    species = getattr(genome, 'species', {})
+    for charge in species.values():
+        if isinstance(charge, list) or callable(charge) or float(charge):
+            return False
+    for field in fields:
+        if field.container.split()[0] != 'lennard':
+            return False
+    modelled = set(['species'])
+    modelled.update( _words('%s %s' % item) for item in species.items() )
+    for field in fields:
+        modelled.update([_words(field.container), _words(field.template)])
+    lines = getattr(genome, 'template', '').split('\n')
+    return all( _words(line) in modelled for line in lines if line.strip() )
+
+def native_terms(org):
+    '''
+    Renders org's fields into a list of pair terms,
+        (elt1, elt2, A, B, m, n, rmin, rmax)
+    with E = A/r^m - B/r^n for rmin < r < rmax.
+    '''
+    values = org.values
+    terms = []
+    for field in org.fields:
+        container = field.container.split()
+        m, n = int(container[1]), int(container[2])
+        nspec = len(' '.join(field.species).split())
+        params = [ float(p) for p in
+                field.template.format(**values).split()[nspec:] ]
+        if len(params) == 3:
+            params.insert(2, 0.0)
+        A, B, rmin, rmax = params[:4]
+        if 'epsilon' in container:
+            A, B = A*float(n)/(m-n)*B**m, A*float(m)/(m-n)*B**n
+        elif 'zero' in container:
+            c = float(m)/(m-n)*(float(m)/n)**(float(n)/(m-n))
+            A, B = A*c*B**m, A*c*B**n
+        elt1, elt2 = [ spec.split()[0] for spec in field.species ]
+        terms.append((elt1, elt2, A, B, m, n, rmin, rmax))
+    return terms
+
+def neighbor_list(cell, frac, rcut):
+    '''
+    Returns every pair (i, j, image) closer than rcut, as arrays of i, j,
+    displacement vectors d = r_j + T - r_i, and distances |d|. Each pair is
+    listed in both directions.
+    '''
+    cell = np.asarray(cell, dtype=float)
+    pos = np.dot(np.mod(frac, 1.0), cell)
+    volume = abs(np.linalg.det(cell))
+    reps = []
+    for k in range(3):
+        area = np.linalg.norm(np.cross(cell[(k+1)%3], cell[(k+2)%3]))
+        reps.append(int(np.ceil(rcut*area/volume)))
+    grid = np.mgrid[-reps[0]:reps[0]+1, -reps[1]:reps[1]+1, -reps[2]:reps[2]+1]
+    shifts = np.dot(grid.reshape(3, -1).T, cell)
+
+    natoms = len(pos)
+    delta = pos[None,:,:] - pos[:,None,:]
+    ii, jj = np.indices((natoms, natoms))
+    ii, jj = ii.ravel(), jj.ravel()
+    delta = delta.reshape(-1, 3)
+    inds_i, inds_j, vecs = [], [], []
+    for shift in shifts:
+        d = delta + shift
+        r2 = (d*d).sum(axis=1)
+        keep = (r2 < rcut*rcut) & (r2 > 1e-12)
+        inds_i.append(ii[keep])
+        inds_j.append(jj[keep])
+        vecs.append(d[keep])
+    vecs = np.concatenate(vecs)
+    return (np.concatenate(inds_i), np.concatenate(inds_j), vecs,
+            np.sqrt((vecs*vecs).sum(axis=1)))
+
+def pair_evaluate(data, terms):
+    elts = [ atom[0] for atom in data.coords ]
+    frac = np.array([ atom[1] for atom in data.coords ], dtype=float)
+    natoms = len(elts)
+    energy = 0.0
+    gradients = np.zeros((natoms, 3))
+    strain = np.zeros(6)
+    if not terms or not natoms:
+        return {'energy':energy, 'forces':gradients, 'stresses':strain}
+
+    i, j, d, r = neighbor_list(data.cell, frac, max(t[7] for t in terms))
+    elts = np.array(elts)
+    ei, ej = elts[i], elts[j]
+    dEdr = np.zeros(len(r))
+    for elt1, elt2, A, B, m, n, rmin, rmax in terms:
+        sel = (((ei == elt1) & (ej == elt2)) | ((ei == elt2) & (ej == elt1)))
+        sel &= (r > rmin) & (r < rmax)
+        rs = r[sel]
+        energy += 0.5*(A/rs**m - B/rs**n).sum()
+        dEdr[sel] += -m*A/rs**(m+1) + n*B/rs**(n+1)
+
+    ### each pair appears twice in the list, hence the factors of 1/2 above
+    ### and below, and the full weight of the gradient on atom i
+    g = (dEdr/r)[:,None]*d
+    for k in range(3):
+        gradients[:,k] = -np.bincount(i, weights=g[:,k], minlength=natoms)
+    voigt = [(0,0), (1,1), (2,2), (1,2), (0,2), (0,1)]
+    for k, (a, b) in enumerate(voigt):
+        strain[k] = 0.5*(g[:,a]*d[:,b]).sum()
+    return {'energy':energy, 'forces':gradients, 'stresses':strain}
+
+def run_native(data_ind, data, terms):
+    '''
+    Evaluates terms on data (a Data object, or a list of them when data_ind
+    is a tuple), returning the result or False, as run_gulp does.
+    '''
+    try:
+        if isinstance(data_ind, tuple):
+            return [ pair_evaluate(d, terms) for d in data ]
+        return pair_evaluate(data, terms)
+    except (ValueError, FloatingPointError, ZeroDivisionError):
+        return False
+
+def native_call(bundle):
+    '''
+    Evaluates a (org_ind, data_ind, (structures path, terms)) bundle, as
+    gulp_call does.
+    '''
+    org_ind, data_ind, (path, terms) = bundle
+    times = {'pid': os.getpid(), 'start': time.time()}
+    data = SharedStructures.attach(path)[data_ind]
+    result = run_native(data_ind, data, terms)
+    times['native'] = time.time() - times['start']
+    return (org_ind, data_ind, result, times)
@@ -5,43 +5,72 @@ import os
 import sys
 import time
 import tempfile
-import itertools
-import multiprocessing as mp
+import json
 import subprocess
 import numpy as np
-import csv
+import cPickle as pickle
 from utils import *
 from config import *
 from data import *
+from pool import Backend, GulpPool, scratch
+from cache import ResultCache
+from runlog import RunLog
+from population import Population
+import breeding
+import constraints
+from islands import Archipelago
+from surrogate import Surrogate
+from memetic import pattern_search
+from instrument import Profiler
+from shared import SharedStructures
+from scheduler import GulpScheduler
+from genome import gulp_input
+from native import native_call, native_terms, supports_native
 from collections import defaultdict
 #from analysis import *
 
-def gulp_call(bundle):
-    org_ind, data_ind, gulp_instr = bundle
-    tmp = tempfile.mkdtemp(dir='/dev/shm')
-    cwd = os.getcwd()
-    os.chdir(tmp)
-    target = tempfile.mktemp(dir=tmp, suffix='.frc')
-    gulp_instr += 'output frc '+target
-    p1 = subprocess.Popen(['echo',gulp_instr],
-            stdout=subprocess.PIPE)
-    p2 = subprocess.Popen(GULP_CMD,
-            #stdout=subprocess.PIPE,
-            stdout=open('/dev/null','w'),
-            stderr=subprocess.PIPE,
-            stdin=p1.stdout)
-    p2.wait()
-    os.chdir(cwd)
-    out, err = p2.communicate()
-    try:
-        frcout = open(target,'r')
-        result = read_frcout(frcout)
-        frcout.close()
+def run_gulp(data_ind, data, pot_string, shells=False, times=None):
+    '''
+    Runs GULP on data (a Data object, or a list of them when data_ind is a
+    tuple) with the rendered potential, in the calling process's scratch
+    directory, returning the parsed result or False. If given a times dict,
+    the seconds spent rendering the input, running GULP and parsing its
+    output are added to it.
+    '''
+    start = time.time()
+    gulp_instr = gulp_input(data, pot_string, shells)
+    tmp = scratch()
+    target = os.path.join(tmp, 'gulp.frc')
+    if os.path.exists(target):
         os.remove(target)
-        os.rmdir(tmp)
-    except:
-        return (org_ind, data_ind, False)
-    return (org_ind, data_ind, result)
+    gulp_instr += 'output frc '+target+'\n'
+    rendered = time.time()
+    devnull = open(os.devnull, 'w')
+    p = subprocess.Popen(GULP_CMD,
+            cwd=tmp,
+            stdout=devnull,
+            stderr=subprocess.PIPE,
+            stdin=subprocess.PIPE)
+    out, err = p.communicate(gulp_instr)
+    devnull.close()
+    finished = time.time()
+    result = read_gulp_output(target, data_ind, data, shells)
+    if times is not None:
+        times.update(render=rendered-start, gulp=finished-rendered,
+                parse=time.time()-finished)
+    return result
+
+def gulp_call(bundle):
+    '''
+    Evaluates a (org_ind, data_ind, (structures path, pot_string, shells))
+    bundle, returning (org_ind, data_ind, result, times), where times are the
+    evaluation's timings (see instrument).
+    '''
+    org_ind, data_ind, (path, pot_string, shells) = bundle
+    times = {'pid': os.getpid(), 'start': time.time()}
+    data = SharedStructures.attach(path)[data_ind]
+    return (org_ind, data_ind,
+            run_gulp(data_ind, data, pot_string, shells, times), times)
 
 
 class Optimizer:
@@ -50,7 +79,15 @@ class Optimizer:
     the potential.
 
     [Fit Options]
-    -fit_size[default=20]: how many data points to fit to
+    -fit_size[default=20]: how many data points to fit to (drawn without
+    repeats)
+    -rotate_every[default=0]: draw a new fit set (a mini-batch) every this many
+    generations, passing through all of the data before reusing any of it
+    (see rotate_fit_data). The whole generation, carried over organisms
+    included, is always scored on the same batch. 0 keeps one fit set for the
+    whole run.
+    -anchor_size[default=0]: how many snapshots of every batch to keep the
+    same throughout the run, when rotating.
     -test_size[default=0]: how many data points to test against independently
     -pop_size[default=100]: how many organisms per generation
     -weights[default={'energy':10, 'stress':1, 'force':1}]: a dictionary
@@ -63,6 +100,75 @@ class Optimizer:
     -p_mutate[default=0.1]: chance of mutating any given gene during breeding.
     -first_generation_size[default=500]: size of the first generation to get a
     pool of reasonably good structures to start with.
+    -batch_breeding[default=True]: breed whole generations at once as gene
+    matrices (see breeding). False breeds one child at a time through select,
+    mate and mutate, for runs which replace those.
+    -seed[default=None]: seed of the per-generation breeding random streams.
+    None draws them from the random module.
+    -islands[default=0]: run this many islands, each evolving its own
+    population in its own process, instead of a single population (see
+    islands). The other options apply to every island; island_options
+    [default=None] can give a dict of overrides for each one.
+    -migrate_every[default=5], migrants[default=2], topology[default='ring']:
+    how often islands send their best organisms to their neighbours, how
+    many, and which islands neighbour which ('ring', 'complete', 'random',
+    or a dict of island: [islands it sends to]).
+
+    [Evaluation Options]
+    -processes[default=None]: number of GULP worker processes to keep alive
+    for the run (None uses every core).
+    -batch_structures[default=False]: evaluate each organism on the whole fit
+    set in a single multi-structure GULP run, instead of one run per snapshot.
+    -evaluator[default='gulp']: 'gulp' always calls GULP, 'native' evaluates
+    pair-potential genomes in-process (see native.py), and 'auto' uses the
+    native evaluator whenever the genome supports it (i.e. its template holds
+    only uncharged species and lennard fields), and GULP otherwise.
+    -engine[default='pool']: how evaluations are dispatched. 'pool' hands them
+    to a GulpPool of worker processes, 'scheduler' starts and polls GULP runs
+    from the parent with a GulpScheduler, which can enforce the timeout.
+    Any other Backend instance (e.g. a remote.Coordinator, to spread work
+    over several hosts) is used as given, and left open after the run.
+    -timeout[default=None]: wall time (in seconds) any one GULP run may take
+    under the 'scheduler' engine before it is killed, and its organism with
+    it.
+    -racing[default=False]: evaluate generations by successive halving (see
+    race): organisms are dropped once they are clearly outside of contention
+    on part of the fit set, rather than always being evaluated on all of it.
+    -race_start[default=2], race_growth[default=2], race_margin[default=0.25],
+    race_tolerance[default=0.01]: initial slice size, slice growth factor,
+    elimination margin and ignored tournament share for racing.
+    -checkpoint_every[default=10]: write a checkpoint (to checkpoint_file,
+    default 'ipr.chk') every this many generations, from which the run can be
+    continued with resume. 0 disables checkpointing.
+    -surrogate[default=False]: prescreen children with a regression model of
+    the errors of every organism evaluated so far (see surrogate), and only
+    evaluate the most promising ones. Once it has seen surrogate_min
+    [default=50] organisms, surrogate_factor[default=3] times as many children
+    are bred as needed, and the best predicted are kept, except for a
+    surrogate_explore[default=0.2] share kept at random.
+    -refine_every[default=0]: every this many generations, refine the
+    refine_top[default=3] best organisms by a local search within the gene
+    bounds (see refine_elite), over refine_iterations[default=3] rounds with
+    initial steps of refine_step[default=0.05] times each gene's range. 0
+    disables refinement.
+    -cache_size[default=100000]: how many (organism, snapshot) results to keep
+    in the evaluation cache; identical organisms are never evaluated twice
+    while their results are cached. 0 disables the cache.
+    -log_file[default='ipr.log']: binary run log with the genes and errors of
+    every organism in every generation (see runlog, and analysis.read_log).
+    -best_file[default='best.pot']: where the best potential is written.
+    -hall_size[default=10]: how many of the latest generation winners to keep
+    in memory once they leave the population. All other organisms are evicted
+    from the population (see population) when they do; their genes and errors
+    remain in the run log.
+    -profile[default=False]: time each phase of every generation (breeding,
+    prescreening, evaluation, fitness, output...) and every evaluation
+    (queue wait, input rendering, GULP wall time, parsing), and count
+    evaluations, cache hits, failures, timeouts and rejected candidates (see
+    instrument). Each generation's totals are appended to profile_file
+    [default='ipr.prof'] as a line of JSON, and every span is also written
+    as a Chrome trace (a JSON timeline) to trace_file[default=None], if set.
+    Functions subscribed to self.profiler are called with every span.
 
     [Extras]
     -rescale_threshold[default=
@@ -70,14 +176,48 @@ class Optimizer:
     '''
 
     fit_size = 20
+    rotate_every = 0
+    anchor_size = 0
     tourn_size = 5
     pop_size = 100
     f_replace = 1.0
     p_mutate = 0.1
     first_generation_size = 500
-    weights = {'energy':10.0,
-            'stress':1.0,
-            'force':1.0}
+    batch_breeding = True
+    seed = None
+    islands = 0
+    migrate_every = 5
+    migrants = 2
+    topology = 'ring'
+    island_options = None
+    processes = None
+    batch_structures = False
+    evaluator = 'gulp'
+    engine = 'pool'
+    timeout = None
+    racing = False
+    race_start = 2
+    race_growth = 2
+    race_margin = 0.25
+    race_tolerance = 0.01
+    checkpoint_every = 10
+    checkpoint_file = 'ipr.chk'
+    cache_size = 100000
+    log_file = 'ipr.log'
+    best_file = 'best.pot'
+    hall_size = 10
+    profile = False
+    profile_file = 'ipr.prof'
+    trace_file = None
+    surrogate = False
+    surrogate_factor = 3
+    surrogate_explore = 0.2
+    surrogate_min = 50
+    refine_every = 0
+    refine_top = 3
+    refine_iterations = 3
+    refine_step = 0.05
+    weights = dict(WEIGHTS)
     rescale_threshold = 0.05
     sliding_threshold = 0.25
 
@@ -87,39 +227,57 @@ class Optimizer:
         self.genome = genome
 
         ### run cont_vars
-        self.data = {}  ## all available data
+        self.data = DataSet()  ## all available data
         self.fit_set = [] ## data to fit to
         self.test_set = [] ## independent test set
-        self.organisms = {}
+        self.anchor_set = [] ## data in every fit set, when rotating
+        self._epoch = [] ## data left to rotate through
+        self.organisms = Population()
         self.generations = []
         self.results = []
+        self.pool = None
+        self.scheduler = None
+        self.cache = None
+        self.runlog = None
+        self.migration = None
+        self.surrogate_model = None
+        self.profiler = Profiler()
+        self._acceptance = 1.0
+        self._structures = None
+
+    def load_data(self, path, start=0, stop=None, stride=1):
+        self.data.extend(read_arrays(path, start, stop, stride,
+                processes=self.processes))
+        self._structures = None
 
-    def load_data(self, path):
-        data = Data.read_path(path)
-        for d in data:
-            d.id = len(self.data)
-            self.data[d.id] = d
+    @property
+    def structures(self):
+        '''
+        SharedStructures holding every snapshot in self.data, which evaluation
+        workers read structures from, each keeping up to a fit set's worth.
+        '''
+        if (self._structures is None or
+                len(self._structures) != len(self.data) or
+                self._structures.cache_size != self.fit_size):
+            self._structures = SharedStructures(self.data,
+                    cache_size=self.fit_size)
+        return self._structures
 
     ### Evaluate fitness
 
     @property
     def best(self):
-        evaled = [ self.organisms[o] for o in self.generations[-1]]
-        return sorted( evaled, key=lambda x: x.fitness )[0]
+        return self.organisms.best()
 
     @property
     def genes(self):
-        genes = []
-        for org in self.organisms.values():
-            genes.append(org[k] for k in self.keys)
-        genes = np.array(genes)
-        return genes.T
+        return self.organisms.gene_matrix(self.organisms.keys()).T
 
     @property
     def keys(self):
         if not self.organisms:
             self.create_organism()
-        return self.organisms[0].genes.keys()
+        return self.organisms.cont_names
 
     def evaluate(self, org, data):
         if isinstance(org, int):
@@ -133,107 +291,306 @@ class Optimizer:
         else:
             data_ind = data.id
 
-        instr = org.gulp(data)
-        return gulp_call((org_ind, data_ind, instr))
-
-    def bulk_evaluate(self, 
-            datas=None, 
-            orgs=None,
-            verbosity=0):
+        if self.native:
+            return native_call((org_ind, data_ind, self.task(org)))[:3]
+        return gulp_call((org_ind, data_ind, self.task(org)))[:3]
 
-        if not datas:
-            datas = list(self.fit_set)
-        if not orgs:
-            orgs = list(self.generations[-1])
+    @property
+    def native(self):
+        '''Whether evaluations bypass GULP (see the evaluator option)'''
+        if self.evaluator == 'gulp':
+            return False
+        supported = supports_native(self.genome)
+        if self.evaluator == 'native' and not supported:
+            raise ValueError('genome cannot be evaluated natively')
+        return supported
+
+    def task(self, org):
+        '''
+        Returns the organism's part of an evaluation bundle: where to find the
+        shared structures, and its potential, either rendered for GULP or as
+        native pair terms.
+        '''
+        if self.native:
+            return (self.structures.path, native_terms(org))
+        return (self.structures.path, org.pot_string,
+                'shellmode' in org.constants)
+
+    def engine_for(self, call):
+        '''Returns the Backend to map call over.'''
+        if isinstance(self.engine, Backend):
+            return self.engine
+        if self.engine == 'scheduler' and call is gulp_call:
+            if self.scheduler is None:
+                self.scheduler = GulpScheduler(self.processes, self.timeout)
+            return self.scheduler
+        if self.pool is None:
+            self.pool = GulpPool(self.processes)
+        return self.pool
+
+    def kill(self, org):
+        '''
+        Marks an organism that couldn't be evaluated as dead, so that it is
+        never ranked or selected.
+        '''
+        org = self.organisms[org]
+        org.fitness = float('inf')
+        org.killed = True
 
-        p = mp.Pool()
-        tests =  itertools.product(orgs, datas)
-        todo = [ (org, data, self.organisms[org].gulp(self.data[data])) 
-                for org, data in tests ]
+    def evaluate_pairs(self, orgs, datas):
+        '''
+        Evaluates every organism in orgs on every snapshot in datas, through
+        the cache. Returns the results, as org_results[org][data], and the set
+        of organisms that failed to evaluate (which are killed). Runs which
+        timed out are not cached, so that their potentials can be tried again.
+        '''
+        if self.cache is None:
+            self.cache = ResultCache(self.cache_size)
+        profiler = self.profiler
 
-        print ' - Calculating ', len(todo), 'pairs...',
+        killed = set()
+        org_results = defaultdict(dict)
+        missing = defaultdict(list)
+        hits = 0
+        for org in orgs:
+            fingerprint = self.organisms[org].fingerprint
+            for data in datas:
+                result = self.cache.get((fingerprint, data))
+                if result is None:
+                    missing[org].append(data)
+                    continue
+                hits += 1
+                if result is False:
+                    self.kill(org)
+                    killed.add(org)
+                else:
+                    org_results[org][data] = result
+        print ' - Cache hit rate: %d/%d (%.1f%%)' % (hits,
+                len(orgs)*len(datas), 100.0*hits/max(len(orgs)*len(datas), 1))
+        profiler.count('cache hits', hits)
+
+        tasks = dict( (org, self.task(self.organisms[org]))
+                for org in orgs if missing[org] )
+        if self.batch_structures:
+            todo = [ (org, tuple(missing[org]), tasks[org])
+                    for org in orgs if missing[org] ]
+            print ' - Calculating ', len(todo), 'organisms on', len(datas),
+            print 'structures...',
+        else:
+            todo = [ (org, data, tasks[org])
+                    for org in orgs for data in missing[org] ]
+            print ' - Calculating ', len(todo), 'pairs...',
         sys.stdout.flush()
 
-        results = p.map_async(gulp_call, todo)
-        results.wait()
-        results = results.get()
+        results = []
+        if todo:
+            call = native_call if self.native else gulp_call
+            engine = self.engine_for(call)
+            timeouts = getattr(engine, 'timeouts', 0)
+            submitted = time.time()
+            with profiler.phase('dispatch', evaluations=len(todo)):
+                results = engine.map(call, todo)
+            profiler.count('evaluations', len(todo))
+            profiler.count('timeouts', getattr(engine, 'timeouts', 0)-timeouts)
         print 'finished!'
 
-        any_good = False
-        killed = set()
-        org_results = defaultdict(dict)
-        for org, data, result in results:
+        for item in results:
+            org, data, result = item[:3]
+            times = item[3] if len(item) > 3 else None
+            if profiler.enabled:
+                profiler.record_evaluation(times, submitted)
+            fingerprint = self.organisms[org].fingerprint
+            if times and times.get('timed_out'):
+                ## a run that was cut short may well succeed another time
+                pass
+            elif isinstance(data, tuple):
+                for d, r in zip(data, result or [False]*len(data)):
+                    self.cache.put((fingerprint, d), r)
+            else:
+                self.cache.put((fingerprint, data), result)
             if not result:
                 #print 'Killing', org
+                profiler.count('failures')
                 self.kill(org)
                 killed.add(org)
                 continue
-            org_results[org][data] = result
+            if isinstance(data, tuple):
+                org_results[org].update(zip(data, result))
+            else:
+                org_results[org][data] = result
 
-        if killed:
-            print " - %s organisms didn't successfully evaluate" % len(killed)
         for k in killed:
-            if k in org_results.keys():
+            if k in org_results:
                 del org_results[k]
+        return org_results, killed
 
-        self.fitness(org_results)
-        self.generations[-1] = sorted(org_results.keys(), key=lambda k:
-                self.organisms[k].fitness)
+    def race(self, orgs, datas):
+        '''
+        Successive-halving evaluation. All organisms are evaluated on the first
+        race_start snapshots of datas; those whose error is already well
+        outside the band of organisms with a realistic chance of winning a
+        tournament are dropped, and the survivors are evaluated on a slice
+        race_growth times larger, until they have seen all of datas.
+
+        The band is the smallest set of top-ranked organisms that wins all
+        but race_tolerance of tournaments (of tourn_size). An organism is
+        dropped if its error is more than (1+race_margin) times that of the
+        last organism in the band.
+
+        Returns the results of the survivors and the killed organisms, as
+        evaluate_pairs.
+        '''
+        alive = list(orgs)
+        killed = set()
+        org_results = defaultdict(dict)
+        n = min(max(self.race_start, 1), len(datas))
+        done = 0
+        while True:
+            results, dead = self.evaluate_pairs(alive, datas[done:n])
+            killed |= dead
+            alive = [ o for o in alive if o not in dead ]
+            for o in alive:
+                org_results[o].update(results[o])
+            if n >= len(datas) or not alive:
+                break
+
+            org_ids, errors = self.errors(dict( (o, org_results[o])
+                for o in alive ))
+            scores = sum( self.weights[k]*e/max(e.mean(), 1e-300)
+                    for k, e in zip(['energy', 'stress', 'force'], errors) )
+            band = int(np.ceil(len(alive)*(1 -
+                self.race_tolerance**(1.0/self.tourn_size))))
+            band = min(max(band, self.tourn_size,
+                int(round(self.pop_size*(1-self.f_replace)))), len(alive))
+            cutoff = (1+self.race_margin)*np.sort(scores)[band-1]
+            alive = [ o for o, score in zip(org_ids, scores)
+                    if score <= cutoff ]
+            print ' - Racing: %d organisms left after %d/%d structures' % (
+                    len(alive), n, len(datas))
+            done, n = n, min(max(n*self.race_growth, n+1), len(datas))
+        return dict( (o, org_results[o]) for o in alive ), killed
 
-    def evaluate_generation(self, generation):
+    def bulk_evaluate(self, 
+            datas=None, 
+            orgs=None,
+            verbosity=0,
+            race=None):
+        '''
+        Evaluates orgs (by default the current generation) on datas (by
+        default the fit set), scores them and ranks them as the current
+        generation. With racing on (or race=True), organisms may be dropped
+        along the way (see race); race=False evaluates every organism fully,
+        for re-ranking a generation which has already been raced.
+        '''
+
+        if not datas:
+            datas = list(self.fit_set)
+        if not orgs:
+            orgs = list(self.generations[-1])
+        if race is None:
+            race = self.racing
+
+        if race:
+            org_results, killed = self.race(orgs, datas)
+        else:
+            org_results, killed = self.evaluate_pairs(orgs, datas)
+
+        if killed:
+            print " - %s organisms didn't successfully evaluate" % len(killed)
+        if not org_results:
+            if not self.organisms.ranked:
+                raise RuntimeError('no organism could be evaluated')
+            print ' - No organism evaluated successfully; keeping the',
+            print 'previous ranking'
+            self.generations[-1] = list(self.organisms.ranked)
+            return
+
+        with self.profiler.phase('fitness'):
+            self.fitness(org_results)
+            self.generations[-1] = self.organisms.rank(sorted(org_results),
+                    self.hall_size)
+        if self.surrogate:
+            with self.profiler.phase('learn'):
+                self.learn(org_results.keys())
+
+    def evaluate_generation(self, generation, race=None):
         self.bulk_evaluate(datas=self.fit_set,
-                orgs=self.generations[generation])
+                orgs=self.generations[generation], race=race)
 
-    def evaluate_next(self):
-        self.evaluate_generation(len(self.generations)-1)
+    def evaluate_next(self, race=None):
+        self.evaluate_generation(len(self.generations)-1, race)
 
     ### fitness function
-    def fitness(self, results):
+    def reference(self, data_ids):
+        '''
+        Returns the stacked reference outputs (see DataSet.stack) for data_ids,
+        reusing the previous stack when asked for the same snapshots again.
+        '''
+        key = tuple(data_ids)
+        if getattr(self, '_reference', (None,))[0] != key:
+            self._reference = (key, self.data.stack(data_ids))
+        return self._reference[1]
+
+    def errors(self, results):
+        '''
+        Returns the organism ids in results, and their mean absolute energy,
+        stress and force errors over the snapshots they were evaluated on, as
+        arrays aligned with the ids.
+        '''
         org_ids = results.keys()
-        data_ids = results.values()[0].keys()
-
-        net_e_err = 0.0
-        net_s_err = 0.0
-        net_f_err = 0.0
-
-        for o in org_ids:
-            org = self.organisms[o]
-            org.e_err = 0.0
-            org.s_err = 0.0
-            org.f_err = 0.0
-            for d in data_ids:
-                e_err = results[o][d]['energy'] - self.data[d].energy
-                s_err = results[o][d]['stresses'] - self.data[d].stresses
-                f_err = results[o][d]['forces'] - self.data[d].forces
-                org.e_err += abs(e_err)
-                org.s_err += np.average(abs(s_err))
-                org.f_err += np.average(np.average(abs(f_err)))
-            org.energy_err = org.e_err/len(data_ids)
-            org.stress_err = org.s_err/len(data_ids)
-            org.force_err = org.f_err/len(data_ids)
-            net_e_err += org.energy_err
-            net_s_err += org.stress_err
-            net_f_err += org.force_err
-
-        for o in org_ids:
-            org = self.organisms[o]
-            org.energy_fitness = org.energy_err/net_e_err
-            org.stress_fitness = org.stress_err/net_s_err
-            org.force_fitness = org.force_err/net_f_err
-            org.fitness = sum([
-                self.weights['energy']*org.energy_fitness,
-                self.weights['stress']*org.stress_fitness,
-                self.weights['force']*org.force_fitness])
+        data_ids = sorted(results.values()[0].keys())
+        ref = self.reference(data_ids)
+        offsets = ref['offsets']
+
+        ### scatter predictions into (organisms x structures) arrays
+        energies = np.empty((len(org_ids), len(data_ids)))
+        stresses = np.empty((len(org_ids),) + ref['stresses'].shape)
+        forces = np.empty((len(org_ids),) + ref['forces'].shape)
+        for i, o in enumerate(org_ids):
+            for j, d in enumerate(data_ids):
+                energies[i,j] = results[o][d]['energy']
+                stresses[i,j] = results[o][d]['stresses']
+                forces[i,offsets[j]:offsets[j+1]] = results[o][d]['forces']
+
+        ### mean absolute errors per structure, averaged over structures
+        e_err = abs(energies - ref['energy']).mean(axis=1)
+        s_err = abs(stresses - ref['stresses']).mean(axis=2).mean(axis=1)
+        f_err = np.add.reduceat(abs(forces - ref['forces']).sum(axis=2),
+                offsets[:-1], axis=1)
+        f_err = (f_err/(3*np.diff(offsets))).mean(axis=1)
+        return org_ids, (e_err, s_err, f_err)
+
+    def weighted_error(self, e_err, s_err, f_err):
+        '''
+        Absolute counterpart of fitness (which is relative to the rest of the
+        generation): the errors summed with the fit weights.
+        '''
+        return (self.weights['energy']*e_err + self.weights['stress']*s_err +
+                self.weights['force']*f_err)
+
+    def fitness(self, results):
+        if not results:
+            return
+        org_ids, (e_err, s_err, f_err) = self.errors(results)
+        n_data = len(results.values()[0])
+
+        e_fit = e_err/e_err.sum()
+        s_fit = s_err/s_err.sum()
+        f_fit = f_err/f_err.sum()
+        fitness = (self.weights['energy']*e_fit +
+                self.weights['stress']*s_fit +
+                self.weights['force']*f_fit)
+
+        self.organisms.score(org_ids,
+                e_err=e_err*n_data, s_err=s_err*n_data, f_err=f_err*n_data,
+                energy_err=e_err, stress_err=s_err, force_err=f_err,
+                energy_fitness=e_fit, stress_fitness=s_fit,
+                force_fitness=f_fit, fitness=fitness)
 
     ### Selection operators
 
     def _tournament_select(self):
-        orgs=[]
-        for i in range(self.tourn_size):
-            orgs.append(random.choice(self.generations[-1]))
-        orgs = sorted(orgs, key=lambda k:
-                self.organisms[k].fitness)
-        return self.organisms[orgs[0]]
+        return self.organisms.tournament(self.tourn_size)
 
     def _roulette_select(self):
         total = sum([ self.organisms[k].fitness for k in self.generations[-1] ])
@@ -258,9 +615,9 @@ class Optimizer:
             child.genes[k] = p1_frac*org1.genes[k]+(1-p1_frac)*org2.genes[k]
         for k in self.genome.disc_vars:
             if random.random() < 0.5:
-                child.genes[k] = org1[k]
+                child.genes[k] = org1.genes[k]
             else:
-                child.genes[k] = org2[k]
+                child.genes[k] = org2.genes[k]
         return child
 
     def mate(self, org1, org2):
@@ -292,22 +649,35 @@ class Optimizer:
     ### Population management
 
     def create_organism(self):
-        org = self.genome()
-        org.id = len(self.organisms)
-        self.organisms[org.id] = org
-        return org
+        return self.organisms.create(self.genome)
 
     def initialize_population(self):
+        size = self.first_generation_factor*self.pop_size
+        if self.batch_breeding:
+            rng = self.generation_rng()
+            bounds, values = self.gene_ranges()
+            self.generations = [self.sample(lambda m:
+                breeding.random_genes(rng, m, bounds, values), size)]
+            return
         gen = []
-        while len(gen) < self.first_generation_factor*self.pop_size:
+        while len(gen) < size:
             child = self.create_organism()
             gen.append(child.id)
         self.generations= [gen]
 
     def create_generation(self):
-        gen = []
-        for i in range(int(round(self.pop_size*(1-self.f_replace)))):
-            gen.append(self.generations[-1][i])
+        self.organisms.retain(self.generations[-1])
+        gen = self.organisms.elite(
+                int(round(self.pop_size*(1-self.f_replace))))
+
+        if self.batch_breeding:
+            n = self.pop_size-len(gen)
+            if self.screening:
+                n *= self.surrogate_factor
+            self.generations.append(gen + self.breed(n))
+            with self.profiler.phase('prescreen'):
+                self.prescreen()
+            return
 
         while len(gen) < self.pop_size:
             parent1 = self.select()
@@ -318,10 +688,195 @@ class Optimizer:
 
         self.generations.append(gen)
 
+    ### Batched breeding
+
+    def generation_rng(self):
+        '''
+        The random stream for breeding the next generation: seeded from seed
+        and the generation number, or when seed is None, from the random
+        module (so that random.seed and checkpoints cover it too).
+        '''
+        if self.seed is None:
+            return np.random.RandomState(random.getrandbits(32))
+        return np.random.RandomState([self.seed, len(self.generations)])
+
+    def gene_ranges(self):
+        '''
+        The bounds of the continuous genes (narrowed by any Bound constraints)
+        and the values of the discrete ones, in the column order of the
+        population's gene matrices.
+        '''
+        ranges = constraints.ranges(self.genome)
+        bounds = [ ranges[k] for k in sorted(ranges) ]
+        values = [ self.genome.disc_vars[k]
+                for k in sorted(self.genome.disc_vars) ]
+        return bounds, values
+
+    def feasible(self, cont, disc):
+        '''
+        Which rows of the gene matrices satisfy the genome's constraints, all
+        checked at once (see constraints).
+        '''
+        genes = dict(zip(sorted(self.genome.cont_vars), cont.T))
+        genes.update(zip(sorted(self.genome.disc_vars), disc.T))
+        return constraints.feasible(self.genome, genes, len(cont))
+
+    def sample(self, draw, n):
+        '''
+        Adds n valid organisms to the population from the candidates returned
+        by draw(m) (the gene matrices of m of them), returning their ids.
+        Candidates are drawn in bulk, oversampling by the share of them which
+        has been valid so far.
+        '''
+        org_ids = []
+        while len(org_ids) < n:
+            need = n - len(org_ids)
+            cont, disc = draw(int(np.ceil(need/max(self._acceptance, 0.01))))
+            ok = self.feasible(cont, disc)
+            self._acceptance = ok.mean()
+            self.profiler.count('candidates', len(ok))
+            self.profiler.count('rejected', len(ok)-ok.sum())
+            self.profiler.count('draws')
+            keep = np.flatnonzero(ok)[:need]
+            org_ids += self.organisms.extend(self.genome, cont[keep],
+                    disc[keep])
+        return org_ids
+
+    def breed(self, n):
+        '''
+        Breeds n valid children of the ranked current generation, all at once
+        (see breeding), returning their ids.
+        '''
+        rng = self.generation_rng()
+        parents = self.organisms.ranked
+        cont = self.organisms.gene_matrix(parents)
+        disc = self.organisms.disc_matrix(parents)
+        bounds, values = self.gene_ranges()
+        return self.sample(lambda m: breeding.breed(rng, cont, disc, m,
+            self.tourn_size, self.p_mutate, bounds, values), n)
+
+    ### Surrogate prescreening
+
+    def learn(self, org_ids):
+        '''
+        Adds the organisms among org_ids which the surrogate hasn't seen yet
+        (those newer than the last one it has) to its history.
+        '''
+        if self.surrogate_model is None:
+            self.surrogate_model = Surrogate(*self.gene_ranges())
+        model = self.surrogate_model
+        new = [ o for o in org_ids if o > model.seen ]
+        if not new:
+            return
+        rows = self.organisms.rows(new)
+        scores = self.organisms.scores
+        errors = self.weighted_error(scores['energy_err'][rows],
+                scores['stress_err'][rows], scores['force_err'][rows])
+        model.add(self.organisms.gene_matrix(new),
+                self.organisms.disc_matrix(new), errors)
+        model.seen = max(new)
+
+    @property
+    def screening(self):
+        '''Whether the surrogate has seen enough organisms to prescreen.'''
+        return (self.surrogate and self.surrogate_model is not None and
+                len(self.surrogate_model) >= self.surrogate_min)
+
+    def prescreen(self):
+        '''
+        Cuts the children of a new generation bred in excess (see
+        surrogate_factor) back to pop_size, as part of create_generation: the
+        ones with the lowest errors predicted by the surrogate, plus a
+        surrogate_explore share drawn at random from the rest. The others are
+        discarded without ever being evaluated.
+        '''
+        gen = self.generations[-1]
+        if not self.screening or len(gen) <= self.pop_size:
+            return
+        n_elite = int(round(self.pop_size*(1-self.f_replace)))
+        elite, children = gen[:n_elite], gen[n_elite:]
+        n = self.pop_size - n_elite
+        predicted = self.surrogate_model.predict(
+                self.organisms.gene_matrix(children),
+                self.organisms.disc_matrix(children))
+        order = list(np.argsort(predicted, kind='mergesort'))
+        n_explore = int(round(n*self.surrogate_explore))
+        chosen = order[:n-n_explore]
+        chosen += random.sample(order[n-n_explore:], n_explore)
+        chosen = set(chosen)
+        self.organisms.discard([ o for i, o in enumerate(children)
+            if i not in chosen ])
+        self.generations[-1] = elite + [ o for i, o in enumerate(children)
+                if i in chosen ]
+        print ' - Surrogate: kept %d of %d children' % (n, len(children))
+        self.profiler.count('screened out', len(children)-n)
+
+    ### Local refinement
+
+    def objective(self, cont, disc):
+        '''
+        Weighted errors (see weighted_error) on the fit set of candidates with
+        the given gene matrices, evaluated in one batch. Candidates which are
+        invalid or fail to evaluate get inf. The candidates are not kept in
+        the population, but their results are cached.
+        '''
+        errors = np.empty(len(cont))
+        errors.fill(np.inf)
+        ok = np.flatnonzero(self.feasible(cont, disc))
+        if not len(ok):
+            return errors
+        org_ids = self.organisms.extend(self.genome, cont[ok], disc[ok])
+        try:
+            org_results, killed = self.evaluate_pairs(org_ids,
+                    list(self.fit_set))
+            if org_results:
+                ids, (e_err, s_err, f_err) = self.errors(org_results)
+                index = dict( (o, i) for i, o in zip(ok, org_ids) )
+                errors[[ index[o] for o in ids ]] = self.weighted_error(
+                        e_err, s_err, f_err)
+        finally:
+            self.organisms.discard(org_ids)
+        return errors
+
+    def refine_elite(self):
+        '''
+        Runs a local search (see memetic.pattern_search) from each of the
+        refine_top best organisms of the current generation, for
+        refine_iterations batched rounds, with steps of refine_step times
+        each gene's range. Organisms which improve are replaced by their
+        refined versions, and the generation is ranked again (without
+        racing it a second time).
+        '''
+        top = self.organisms.elite(self.refine_top)
+        if not top:
+            return
+        bounds, values = self.gene_ranges()
+        bounds = np.array(bounds, dtype=float).reshape(-1, 2)
+        disc = self.organisms.disc_matrix(top)
+        cont, errors, moved = pattern_search(
+                lambda x, owners: self.objective(x, disc[owners]),
+                self.organisms.gene_matrix(top),
+                self.refine_step*(bounds[:,1]-bounds[:,0]),
+                bounds, self.refine_iterations)
+        if not moved.any():
+            return
+        refined = self.organisms.extend(self.genome, cont[moved], disc[moved])
+        replace = dict(zip([ top[i] for i in np.flatnonzero(moved) ], refined))
+        size = len(self.generations[-1])
+        self.generations[-1] = [ replace.get(o, o)
+                for o in self.generations[-1] ]
+        print ' - Refined %d of the %d best organisms' % (len(refined),
+                len(top))
+        self.evaluate_next(race=False)
+        if len(self.generations[-1]) != size:
+            raise RuntimeError('refinement changed the size of generation %d '
+                    'from %d to %d' % (len(self.generations)-1, size,
+                        len(self.generations[-1])))
+
     ### Optional optimization stuff
 
     def rescale(self):
-        if len(self.organisms) < 1000:
+        if self.organisms.created < 1000:
             return
         for k, data in zip(self.genes, self.keys()):
             if k not in self.genome.cont_vars:
@@ -329,7 +884,7 @@ class Optimizer:
 
 
     def shift(self):
-        if len(self.organisms) < 1000:
+        if self.organisms.created < 1000:
             return
         for k, data in zip(self.genes, self.keys()):
             if k in self.genome.cont_vars:
@@ -344,27 +899,142 @@ class Optimizer:
     ### Fit data selection / validation
 
     def _random_fit_data(self):
-        self.fit_set = []
-        while len(self.fit_set) < self.fit_size:
-            self.fit_set.append(random.choice(self.data.keys()))
+        keys = self.data.keys()
+        self.fit_set = random.sample(keys, min(self.fit_size, len(keys)))
 
     def select_fit_data(self):
+        if self.rotate_every:
+            return self.rotate_fit_data()
         return self._random_fit_data()
 
+    def rotate_fit_data(self):
+        '''
+        Moves the fit set on to the next mini-batch: the anchor set
+        (anchor_size snapshots, drawn once and part of every batch) and the
+        next snapshots of a shuffled pass through the rest of the data, so
+        that every snapshot is fitted to before any is used again. No
+        snapshot appears twice in a batch.
+        '''
+        keys = sorted(self.data.keys())
+        size = min(self.fit_size, len(keys))
+        if len(self.anchor_set) != min(self.anchor_size, size):
+            self.anchor_set = random.sample(keys, min(self.anchor_size, size))
+        anchors = set(self.anchor_set)
+        batch = []
+        while len(batch) < size - len(anchors):
+            if not self._epoch:
+                self._epoch = [ k for k in keys if k not in anchors ]
+                random.shuffle(self._epoch)
+            k = self._epoch.pop()
+            if k in batch:
+                ## already in from the end of the last pass: it waits for the
+                ## next batch, rather than being skipped in this pass
+                self._epoch.insert(0, k)
+            else:
+                batch.append(k)
+        self.fit_set = self.anchor_set + batch
+
+    ### checkpointing
+
+    def checkpoint(self, filename=None):
+        '''
+        Atomically writes the state of the run to filename (by default
+        checkpoint_file): every resident organism's genes and errors, the
+        generations, the fit and test sets, the random number generator states
+        (and the share of candidates accepted so far, which sets how many each
+        draw asks for), the genome ranges (which shift may have changed), and
+        the cached results of the current generation. The genome's functions
+        and constraints are not saved; they come from the genome the optimizer
+        is resumed with.
+        '''
+        filename = filename or self.checkpoint_file
+        results = {}
+        if self.cache is not None:
+            for o in self.generations[-1]:
+                fingerprint = self.organisms[o].fingerprint
+                for d in self.fit_set:
+                    if (fingerprint, d) in self.cache:
+                        results[(fingerprint, d)] = self.cache.peek(
+                                (fingerprint, d))
+        state = {'organisms': self.organisms.state(),
+                'generations': self.generations,
+                'fit_set': self.fit_set,
+                'anchor_set': self.anchor_set,
+                'epoch': self._epoch,
+                'test_set': self.test_set,
+                'n_data': len(self.data),
+                'random': random.getstate(),
+                'np_random': np.random.get_state(),
+                'cont_vars': self.genome.cont_vars,
+                'disc_vars': self.genome.disc_vars,
+                'surrogate': self.surrogate_model,
+                'acceptance': self._acceptance,
+                'results': results}
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, filename)
+
+    def load_checkpoint(self, filename=None):
+        '''Restores the state saved by checkpoint.'''
+        filename = filename or self.checkpoint_file
+        with open(filename, 'rb') as f:
+            state = pickle.load(f)
+        if state['n_data'] != len(self.data):
+            raise ValueError('checkpoint was made with %d snapshots, %d loaded'
+                    % (state['n_data'], len(self.data)))
+        self.genome.cont_vars = state['cont_vars']
+        self.genome.disc_vars = state['disc_vars']
+        self.organisms = Population.restore(self.genome, state['organisms'])
+        self.generations = state['generations']
+        self.fit_set = state['fit_set']
+        self.anchor_set = state['anchor_set']
+        self._epoch = state['epoch']
+        self.test_set = state['test_set']
+        random.setstate(state['random'])
+        np.random.set_state(state['np_random'])
+        self.surrogate_model = state['surrogate']
+        self._acceptance = state['acceptance']
+        if self.cache is None:
+            self.cache = ResultCache(self.cache_size)
+        for key, result in state['results'].items():
+            self.cache.put(key, result)
+
     ### data logging
-    def initialize_outputs(self):
-        self.keys = self.organisms[0].genes.keys()
-        f = open('ipr.log','w')
-        self.csvf = csv.DictWriter(f, self.keys)        
+    def initialize_outputs(self, mode='w'):
+        '''
+        Opens the run log (see runlog). With mode 'a' the existing log is
+        continued, dropping anything logged after the current generation.
+        '''
+        if self.runlog is not None:
+            self.runlog.close()
+        self.runlog = RunLog(self.log_file, self.genome.cont_vars,
+                self.genome.disc_vars, mode, start=len(self.generations))
 
     def update_results(self):
-        if not hasattr(self, 'csvf'):
+        if self.runlog is None:
             self.initialize_outputs()
-        rows = [ self.organisms[k].genes for k in self.generations[-1] ]
-        self.csvf.writerows(rows)
+        orgs = [ self.organisms[k] for k in self.generations[-1] ]
+        self.runlog.append(len(self.generations)-1, orgs,
+                self.laps[-1]-self.laps[-2])
 
     def update_best(self):
-        self.best.save('best.pot')
+        self.best.save(self.best_file)
+
+    def update_profile(self):
+        '''
+        Appends the profiler's totals since the last generation to
+        profile_file, when profiling, and resets them.
+        '''
+        if not self.profiler.enabled:
+            return
+        summary = self.profiler.summary()
+        summary['generation'] = len(self.generations)-1
+        with open(self.profile_file, 'a') as f:
+            f.write(json.dumps(summary, sort_keys=True)+'\n')
+        phases = sorted(summary['seconds'].items(), key=lambda x: -x[1])
+        print ' - Profile:', ', '.join( '%s %.2fs' % p for p in phases[:4] )
 
     def summarize(self):
         print ' - Best energy fitness:', self.best.energy_err
@@ -396,20 +1066,88 @@ class Optimizer:
             self.create_generation()
             self.evaluate_next()
             self.output()
-        '''
-        print 'Generation 0:\n================'
-        print ' - Initializing'
 
-        self.laps = [time.time()]
-        self.select_fit_data()
-        self.initialize_population()
-        self.evaluate_next()
-        self.laps.append(time.time())
+        All evaluations in the run share one GulpPool (or GulpScheduler), which
+        is shut down when the run finishes or raises. A checkpoint is written
+        every checkpoint_every generations; see resume.
 
-        for gen in range(generations):
-            print 'Generation %s:\n================' % len(self.generations)
-            self.create_generation()
-            self.evaluate_next()
-            self.laps.append(time.time())
-            self.output()
-            #self.refine_genome()
+        With islands > 1, runs an island model instead (see islands), and
+        returns the best organism of all islands.
+        '''
+        if self.islands > 1:
+            archipelago = Archipelago(self, self.islands, self.migrate_every,
+                    self.migrants, self.topology, self.island_options)
+            return archipelago(generations)
+        self._run(generations)
+
+    def resume(self, filename=None, generations=300):
+        '''
+        Continues a run from its last checkpoint (see checkpoint) up to
+        `generations` generations in total. The data, genome and options must
+        be set up as they were for the original run; organisms evaluated
+        before the checkpoint are not evaluated again.
+        '''
+        self.load_checkpoint(filename)
+        self.initialize_outputs(mode='a')
+        self._run(generations, resume=True)
+
+    def _run(self, generations, resume=False):
+        profiler = self.profiler
+        profiler.enabled = self.profile
+        profiler.trace = bool(self.trace_file)
+        print ' - Evaluating with', (
+                'the native evaluator' if self.native else 'GULP')
+        self.pool = GulpPool(self.processes)
+        try:
+            with self.pool:
+                self.laps = [time.time()]
+                if not resume:
+                    print 'Generation 0:\n================'
+                    print ' - Initializing'
+                    self.select_fit_data()
+                    with profiler.phase('breed', generation=0):
+                        self.initialize_population()
+                    with profiler.phase('evaluate', generation=0):
+                        self.evaluate_next()
+                    self.laps.append(time.time())
+                    if self.checkpoint_every:
+                        with profiler.phase('checkpoint', generation=0):
+                            self.checkpoint()
+                    self.update_profile()
+
+                while len(self.generations) <= generations:
+                    generation = len(self.generations)
+                    print 'Generation %s:\n================' % generation
+                    if (self.rotate_every and
+                            generation % self.rotate_every == 0):
+                        self.rotate_fit_data()
+                    with profiler.phase('breed', generation=generation):
+                        self.create_generation()
+                    with profiler.phase('evaluate', generation=generation):
+                        self.evaluate_next()
+                    if self.migration is not None:
+                        with profiler.phase('migrate', generation=generation):
+                            self.migration(self)
+                    if (self.refine_every and
+                            generation % self.refine_every == 0):
+                        with profiler.phase('refine', generation=generation):
+                            self.refine_elite()
+                    self.laps.append(time.time())
+                    with profiler.phase('output', generation=generation):
+                        self.output()
+                    #self.refine_genome()
+                    if (self.checkpoint_every and
+                            generation % self.checkpoint_every == 0):
+                        with profiler.phase('checkpoint',
+                                generation=generation):
+                            self.checkpoint()
+                    self.update_profile()
+        finally:
+            if self.runlog is not None:
+                self.runlog.close()
+                self.runlog = None
+            if self.scheduler is not None:
+                self.scheduler.close()
+                self.scheduler = None
+            if profiler.trace:
+                profiler.write_trace(self.trace_file)
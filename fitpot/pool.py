@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import multiprocessing as mp
+from multiprocessing.util import Finalize
+from config import *
+
+__doc__='''
+Long-lived pool of GULP workers.
+
+Each worker process is started once per run and gets its own scratch
+directory, which every GULP call it makes runs inside of. The scratch
+directories are removed when the workers exit.
+'''
+
+_scratch = None
+
+def _init_worker(root=SCRATCH_DIR):
+    global _scratch
+    if not os.path.isdir(root):
+        root = None
+    _scratch = tempfile.mkdtemp(dir=root, prefix='fitpot-')
+    Finalize(None, shutil.rmtree, args=(_scratch, True), exitpriority=10)
+
+def scratch():
+    '''
+    Returns the scratch directory of the calling process, creating it on first
+    use (i.e. when gulp_call is run outside of a GulpPool).
+    '''
+    if _scratch is None:
+        _init_worker()
+    return _scratch
+
+
+class Backend(object):
+    '''
+    Interface for evaluation backends. A backend maps gulp_call or
+    native_call over a list of (org_ind, data_ind, task) bundles, returning
+    their results in order, and releases its resources on close.
+    '''
+
+    def map(self, func, tasks):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class GulpPool(Backend):
+    '''
+    Wrapper around a multiprocessing.Pool whose workers are initialized with
+    their own scratch directories, and which persists between generations.
+
+    Workers are started on the first map (or an explicit start). Can be used
+    as a context manager, in which case the pool is closed when the block
+    exits, or terminated if the block raised.
+    '''
+
+    def __init__(self, processes=None):
+        self.processes = processes
+        self._pool = None
+
+    @property
+    def running(self):
+        return self._pool is not None
+
+    def start(self):
+        if self._pool is None:
+            self._pool = mp.Pool(self.processes,
+                    initializer=_init_worker,
+                    initargs=(SCRATCH_DIR,))
+        return self
+
+    def map(self, func, tasks):
+        self.start()
+        ## a timeout on get keeps the parent responsive to KeyboardInterrupt
+        return self._pool.map_async(func, tasks).get(1e7)
+
+    def close(self):
+        if self._pool is None:
+            return
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+
+    def terminate(self):
+        if self._pool is None:
+            return
+        self._pool.terminate()
+        self._pool.join()
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+        return False
@@ -0,0 +1,325 @@
+import random
+import numpy as np
+
+__doc__='''
+Array-backed storage of the organisms of a run.
+
+A Population keeps the genes and scores of every resident organism in
+preallocated NumPy arrays (one row per organism), and hands out organisms as
+instances of the run's genome whose genes, id and scores are views onto their
+row. Rows of organisms which are evicted (see retain) are reused, so memory
+stays bounded by the live generation, its children and the hall of fame,
+however long the run. Their genes and errors remain in the run log.
+'''
+
+SCORES = ['fitness', 'energy_err', 'stress_err', 'force_err',
+        'e_err', 's_err', 'f_err',
+        'energy_fitness', 'stress_fitness', 'force_fitness']
+
+class Genes(object):
+    '''Dict-like view of the genes of the organism in a row of a Population.'''
+    __slots__ = ('population', 'row')
+
+    def __init__(self, population, row):
+        self.population = population
+        self.row = row
+
+    def __getitem__(self, k):
+        kind, col = self.population.columns[k]
+        return self.population.genes[kind][self.row, col]
+
+    def __setitem__(self, k, v):
+        kind, col = self.population.columns[k]
+        self.population.genes[kind][self.row, col] = v
+
+    def __contains__(self, k):
+        return k in self.population.columns
+
+    def __iter__(self):
+        return iter(self.population.names)
+
+    def __len__(self):
+        return len(self.population.names)
+
+    def keys(self):
+        return list(self.population.names)
+
+    def values(self):
+        return [ self[k] for k in self.population.names ]
+
+    def items(self):
+        return [ (k, self[k]) for k in self.population.names ]
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.copy())
+
+def _score(name):
+    def get(self):
+        return self._population.scores[name][self._check()]
+    def set(self, value):
+        self._population.scores[name][self._check()] = value
+    return property(get, set)
+
+class Organism(object):
+    '''
+    Mixin for organism handles: a genome instance whose state lives in a row
+    of a Population.
+    '''
+    __slots__ = ('_population', '_row')
+
+    def _check(self):
+        if self._row is None:
+            raise KeyError('organism was evicted from its population')
+        return self._row
+
+    @property
+    def id(self):
+        return int(self._population.ids[self._check()])
+
+    @property
+    def genes(self):
+        return Genes(self._population, self._check())
+
+    @genes.setter
+    def genes(self, genes):
+        view = Genes(self._population, self._check())
+        for k, v in genes.items():
+            view[k] = v
+
+    @property
+    def killed(self):
+        return bool(self._population.killed[self._check()])
+
+    @killed.setter
+    def killed(self, value):
+        self._population.killed[self._check()] = value
+
+for _name in SCORES:
+    setattr(Organism, _name, _score(_name))
+
+class Population(object):
+    '''
+    Dict-like store of organisms, keyed by id. The gene layout is taken from
+    the genome of the first organism created (or from a saved state).
+
+    After a generation is evaluated, rank orders it by fitness, which best,
+    elite and tournament then query without sorting again.
+    '''
+
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.genome = None
+        self.created = 0
+        self.ranked = []
+        self.hall = []
+        self._handles = {}
+        self._free = []
+        self._used = 0
+
+    def _layout(self, genome, capacity=None):
+        self.genome = genome
+        self.handle = type(genome.__name__, (Organism, genome),
+                {'__slots__': ()})
+        self.cont_names = sorted(genome.cont_vars)
+        self.disc_names = sorted(genome.disc_vars)
+        self.names = self.cont_names + self.disc_names
+        self.columns = dict( [ (k, ('cont', i))
+            for i, k in enumerate(self.cont_names) ] + [ (k, ('disc', i))
+            for i, k in enumerate(self.disc_names) ] )
+        n = capacity or self.capacity
+        self.ids = np.zeros(n, dtype=np.int64)
+        self.killed = np.zeros(n, dtype=bool)
+        self.scores = dict( (k, np.zeros(n)) for k in SCORES )
+        self.genes = {'cont':np.zeros((n, len(self.cont_names))),
+                'disc':np.zeros((n, len(self.disc_names)), dtype=object)}
+        self.capacity = n
+
+    def _grow(self):
+        n = 2*self.capacity
+        def grow(array):
+            new = np.zeros((n,)+array.shape[1:], dtype=array.dtype)
+            new[:len(array)] = array
+            return new
+        self.ids = grow(self.ids)
+        self.killed = grow(self.killed)
+        self.scores = dict( (k, grow(v)) for k, v in self.scores.items() )
+        self.genes = dict( (k, grow(v)) for k, v in self.genes.items() )
+        self.capacity = n
+
+    def _allocate(self, org_id):
+        if self._free:
+            row = self._free.pop()
+        else:
+            if self._used == self.capacity:
+                self._grow()
+            row = self._used
+            self._used += 1
+        self.ids[row] = org_id
+        self.killed[row] = False
+        for v in self.scores.values():
+            v[row] = 0.0
+        handle = self.handle.__new__(self.handle)
+        handle._population = self
+        handle._row = row
+        self._handles[org_id] = handle
+        return handle
+
+    def create(self, genome):
+        '''Adds a new organism of genome with random (valid) genes.'''
+        if self.genome is None:
+            self._layout(genome)
+        org = self._allocate(self.created)
+        self.created += 1
+        genome.__init__(org)
+        return org
+
+    def extend(self, genome, cont, disc):
+        '''
+        Adds organisms of genome with the given continuous and discrete gene
+        matrices (columns in the order of cont_names and disc_names),
+        returning their ids.
+        '''
+        if self.genome is None:
+            self._layout(genome)
+        org_ids = range(self.created, self.created+len(cont))
+        for org_id in org_ids:
+            self._allocate(org_id)
+        self.created += len(cont)
+        rows = self.rows(org_ids)
+        self.genes['cont'][rows] = cont
+        self.genes['disc'][rows] = disc
+        return org_ids
+
+    ### dict interface
+
+    def __getitem__(self, org_id):
+        return self._handles[org_id]
+
+    def __contains__(self, org_id):
+        return org_id in self._handles
+
+    def __len__(self):
+        return len(self._handles)
+
+    def __iter__(self):
+        return iter(self._handles)
+
+    def keys(self):
+        return self._handles.keys()
+
+    def values(self):
+        return self._handles.values()
+
+    def items(self):
+        return self._handles.items()
+
+    def rows(self, org_ids):
+        return np.array([ self._handles[o]._row for o in org_ids ],
+                dtype=int)
+
+    def score(self, org_ids, **scores):
+        '''Sets score columns (as arrays in the order of org_ids) in bulk.'''
+        rows = self.rows(org_ids)
+        for k, v in scores.items():
+            self.scores[k][rows] = v
+
+    def gene_matrix(self, org_ids):
+        '''The continuous genes of org_ids, as an (organisms x genes) array.'''
+        return self.genes['cont'][self.rows(org_ids)]
+
+    def disc_matrix(self, org_ids):
+        '''The discrete genes of org_ids, as an (organisms x genes) array.'''
+        return self.genes['disc'][self.rows(org_ids)]
+
+    ### ranking
+
+    def rank(self, org_ids, hall_size=0):
+        '''
+        Orders org_ids by fitness (ties keep their order), remembers the
+        order for best, elite and tournament, and returns it. The best
+        organism joins the hall of fame, which keeps the last hall_size of
+        them.
+        '''
+        org_ids = list(org_ids)
+        order = np.argsort(self.scores['fitness'][self.rows(org_ids)],
+                kind='mergesort')
+        self.ranked = [ org_ids[i] for i in order ]
+        if hall_size and self.ranked:
+            if self.ranked[0] in self.hall:
+                self.hall.remove(self.ranked[0])
+            self.hall = (self.hall + self.ranked[:1])[-hall_size:]
+        return self.ranked
+
+    def best(self):
+        return self._handles[self.ranked[0]]
+
+    def elite(self, n):
+        return self.ranked[:n]
+
+    def tournament(self, size, rng=random):
+        '''
+        The winner of a tournament between size organisms of the ranked
+        generation, drawn with replacement.
+        '''
+        n = len(self.ranked)
+        return self._handles[self.ranked[min( rng.randrange(n)
+            for i in range(size) )]]
+
+    ### retention
+
+    def retain(self, org_ids):
+        '''
+        Evicts every organism except org_ids, the ranked generation and the
+        hall of fame, returning how many were evicted.
+        '''
+        keep = set(org_ids) | set(self.ranked) | set(self.hall)
+        return self.discard([ o for o in self._handles if o not in keep ])
+
+    def discard(self, org_ids):
+        '''Evicts org_ids, returning how many there were.'''
+        for o in org_ids:
+            handle = self._handles.pop(o)
+            self._free.append(handle._row)
+            handle._row = None
+        return len(org_ids)
+
+    ### saving
+
+    def state(self):
+        '''The resident organisms, as plain arrays (see restore).'''
+        org_ids = sorted(self._handles)
+        rows = self.rows(org_ids)
+        return {'ids': np.array(org_ids, dtype=np.int64),
+                'names': self.names,
+                'killed': self.killed[rows],
+                'scores': dict( (k, v[rows]) for k, v in self.scores.items() ),
+                'cont': self.genes['cont'][rows],
+                'disc': self.genes['disc'][rows],
+                'created': self.created,
+                'ranked': list(self.ranked),
+                'hall': list(self.hall)}
+
+    @classmethod
+    def restore(cls, genome, state):
+        '''Recreates a Population of genome from its state.'''
+        population = cls()
+        population._layout(genome, max(population.capacity,
+            len(state['ids'])))
+        if population.names != state['names']:
+            raise ValueError('saved genes %s do not match the genome'
+                    % state['names'])
+        for org_id in state['ids']:
+            population._allocate(int(org_id))
+        n = len(state['ids'])
+        population.killed[:n] = state['killed']
+        for k, v in state['scores'].items():
+            population.scores[k][:n] = v
+        population.genes['cont'][:n] = state['cont']
+        population.genes['disc'][:n] = state['disc']
+        population.created = state['created']
+        population.ranked = state['ranked']
+        population.hall = state['hall']
+        return population
@@ -0,0 +1,253 @@
+import os
+import sys
+import time
+import binascii
+import select
+import argparse
+import threading
+import subprocess
+from collections import deque
+from multiprocessing.connection import Listener, Client
+from config import *
+from data import Data
+from shared import SharedStructures
+from pool import Backend
+
+__doc__='''
+Evaluation across several hosts.
+
+A Coordinator is a Backend which, instead of running evaluations itself,
+listens for workers on a TCP port. Workers are standalone processes,
+started on any host with
+
+    FITPOT_AUTHKEY=KEY python fitpot/remote.py HOST PORT
+
+which connect to the coordinator, pull (organism parameters, snapshot id)
+tasks one at a time, run them with GULP (or the native evaluator) and send
+back the results. The structures a worker needs are sent to it the first
+time it is given a task on them. Workers may join or leave at any time; the
+tasks of a worker that disconnects are requeued.
+
+Connections are authenticated with a key which must match on both ends:
+the one given to the Coordinator, else the FITPOT_AUTHKEY environment
+variable, else a random one drawn for the run (which the Coordinator prints,
+and hands to the workers it spawns itself). Workers refuse to start without
+one. Messages are pickled, so anyone holding the key can run code on the
+other end: keep it secret, and only run workers against coordinators you
+trust, and vice versa. The Coordinator only listens on the loopback
+interface unless given another address.
+'''
+
+def new_key():
+    '''A random authentication key.'''
+    return binascii.hexlify(os.urandom(16))
+
+class Coordinator(Backend):
+    '''
+    Hands out tasks to the workers connected on address (by default the
+    loopback interface, on a free port; see the address attribute for the
+    actual one), authenticated with authkey (see above).
+    '''
+
+    def __init__(self, address=('127.0.0.1', 0), authkey=None):
+        authkey = authkey or AUTHKEY
+        if not authkey:
+            authkey = new_key()
+            print ' - Coordinator key (set FITPOT_AUTHKEY to it on workers):',
+            print authkey
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.authkey = authkey
+        self.workers = {}
+        self.lost = 0
+        self._tasks = {}
+        self._pending = deque()
+        self._results = {}
+        self._next_id = 0
+        self._closed = False
+        self._lock = threading.Condition()
+        self._threads = [ threading.Thread(target=self._accept),
+                threading.Thread(target=self._dispatch) ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def map(self, func, tasks):
+        '''
+        Runs func (gulp_call or native_call) on every bundle in tasks on the
+        connected workers, blocking until all of them are back.
+        '''
+        with self._lock:
+            ids = []
+            for bundle in tasks:
+                self._tasks[self._next_id] = (func.__name__, bundle)
+                self._pending.append(self._next_id)
+                ids.append(self._next_id)
+                self._next_id += 1
+            while not all( i in self._results for i in ids ):
+                self._lock.wait(1.0)
+            for i in ids:
+                del self._tasks[i]
+            return [ self._results.pop(i) for i in ids ]
+
+    @property
+    def local_host(self):
+        '''The host to reach the coordinator at from this host.'''
+        host = self.address[0]
+        if host in ['', '0.0.0.0']:
+            host = 'localhost'
+        return host
+
+    def spawn_local(self, n):
+        '''Starts n workers on this host, returning their Popen handles.'''
+        host = self.local_host
+        script = os.path.splitext(os.path.abspath(__file__))[0]+'.py'
+        ## passed in the environment, which other users can't read
+        env = dict(os.environ, FITPOT_AUTHKEY=self.authkey)
+        return [ subprocess.Popen([sys.executable, script, host,
+            str(self.address[1])], env=env) for i in range(n) ]
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            for conn in self.workers:
+                try:
+                    conn.send(('stop',))
+                    conn.close()
+                except IOError:
+                    pass
+            self.workers = {}
+        ## wake the accept thread up so that it notices
+        try:
+            Client((self.local_host, self.address[1]),
+                    authkey=self.authkey).close()
+        except Exception:
+            pass
+        self.listener.close()
+
+    ### coordinator threads
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                conn = self.listener.accept()
+            except Exception:
+                if self._closed:
+                    return
+                continue
+            with self._lock:
+                if self._closed:
+                    conn.close()
+                    return
+                ## per worker: structures it holds, and its current task
+                self.workers[conn] = {'data':set(), 'task':None}
+
+    def _dispatch(self):
+        while not self._closed:
+            with self._lock:
+                conns = self.workers.keys()
+            if not conns:
+                time.sleep(0.05)
+                continue
+            try:
+                readable = select.select(conns, [], [], 0.05)[0]
+            except (select.error, IOError, ValueError):
+                readable = []
+            with self._lock:
+                if self._closed:
+                    return
+                for conn in readable:
+                    try:
+                        message = conn.recv()
+                    except (EOFError, IOError):
+                        self._lose(conn)
+                        continue
+                    worker = self.workers[conn]
+                    if message[0] == 'result' and worker['task'] is not None:
+                        self._results[worker['task']] = message[1]
+                        worker['task'] = None
+                        self._lock.notify_all()
+                for conn, worker in self.workers.items():
+                    if worker['task'] is None and self._pending:
+                        self._send(conn, worker, self._pending.popleft())
+
+    def _send(self, conn, worker, task_id):
+        kind, (org_ind, data_ind, task) = self._tasks[task_id]
+        path, params = task[0], task[1:]
+        ids = data_ind if isinstance(data_ind, tuple) else (data_ind,)
+        shared = SharedStructures.attach(path)
+        new = dict( (d, (shared[d].cell, shared[d].coords)) for d in ids
+                if (path, d) not in worker['data'] )
+        worker['task'] = task_id
+        try:
+            if new:
+                conn.send(('data', path, new))
+                worker['data'].update( (path, d) for d in new )
+            conn.send(('task', kind, org_ind, data_ind, path, params))
+        except IOError:
+            self._lose(conn)
+
+    def _lose(self, conn):
+        '''Drops a worker, putting its task back at the head of the queue.'''
+        worker = self.workers.pop(conn)
+        if worker['task'] is not None:
+            self._pending.appendleft(worker['task'])
+        self.lost += 1
+
+
+### worker side
+
+def work(address, authkey=None):
+    '''
+    Connects to the Coordinator at address, authenticating with authkey (by
+    default FITPOT_AUTHKEY), and evaluates the tasks it hands out until it
+    says stop or goes away.
+    '''
+    authkey = authkey or AUTHKEY
+    if not authkey:
+        raise ValueError('no authentication key: set FITPOT_AUTHKEY to the '
+                "coordinator's key")
+    from optimizer import run_gulp
+    from native import run_native
+
+    conn = Client(address, authkey=authkey)
+    structures = {}
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, IOError):
+            break
+        if message[0] == 'stop':
+            break
+        elif message[0] == 'data':
+            path, new = message[1], message[2]
+            for data_id, (cell, coords) in new.items():
+                snapshot = Data()
+                snapshot.id = data_id
+                snapshot.cell = cell
+                snapshot.coords = coords
+                structures[(path, data_id)] = snapshot
+        elif message[0] == 'task':
+            kind, org_ind, data_ind, path, params = message[1:]
+            if isinstance(data_ind, tuple):
+                data = [ structures[(path, d)] for d in data_ind ]
+            else:
+                data = structures[(path, data_ind)]
+            times = {'pid': os.getpid(), 'start': time.time()}
+            if kind == 'native_call':
+                result = run_native(data_ind, data, *params)
+                times['native'] = time.time() - times['start']
+            else:
+                result = run_gulp(data_ind, data, *params, times=times)
+            try:
+                conn.send(('result', (org_ind, data_ind, result, times)))
+            except IOError:
+                break
+    conn.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='fitpot evaluation worker')
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    args = parser.parse_args()
+    work((args.host, args.port))
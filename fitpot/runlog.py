@@ -0,0 +1,131 @@
+import os
+import json
+import threading
+import Queue
+import numpy as np
+
+__doc__='''
+Append-only binary log of every organism in every generation.
+
+The file starts with a header,
+
+    FITPOTLOG <header length>
+    <numpy dtype of a record, as JSON>
+
+padded with spaces, followed by fixed size records, one per organism per
+generation:
+
+    generation, id, time (wall time of the generation), energy_err,
+    stress_err, force_err, fitness, then one column per gene (continuous
+    genes as floats, discrete genes as the index of their value)
+
+Records are written by a background thread, a generation at a time, so
+logging never holds up the GA loop, and read back with read_log as a
+memory-mapped structured array, so even very long logs load instantly.
+'''
+
+MAGIC = 'FITPOTLOG'
+_ALIGN = 64
+
+def _dtype(cont_vars, disc_vars):
+    fields = [('generation', '<i4'), ('id', '<i8'), ('time', '<f8'),
+            ('energy_err', '<f8'), ('stress_err', '<f8'), ('force_err', '<f8'),
+            ('fitness', '<f8')]
+    fields += [ (str(k), '<f8') for k in sorted(cont_vars) ]
+    fields += [ (str(k), '<i4') for k in sorted(disc_vars) ]
+    return np.dtype(fields)
+
+def _read_header(f):
+    first = f.readline()
+    if not first.startswith(MAGIC):
+        raise ValueError('%s is not a fitpot run log' % f.name)
+    length = int(first.split()[1])
+    dtype = np.dtype([ tuple(field) for field in json.loads(f.readline()) ])
+    return dtype, length
+
+def read_log(filename):
+    '''
+    Returns the records in a run log as a read-only, memory-mapped structured
+    array (a partially written last record is ignored).
+    '''
+    with open(filename, 'rb') as f:
+        dtype, offset = _read_header(f)
+    count = (os.path.getsize(filename) - offset) // dtype.itemsize
+    if not count:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+            shape=(count,))
+
+class RunLog(object):
+    '''
+    Writer for a run log. mode 'w' starts a new log, 'a' appends to an
+    existing one (whose columns must match), first dropping the records of
+    generation start onwards, if given.
+    '''
+
+    def __init__(self, filename, cont_vars, disc_vars, mode='w', start=None):
+        self.filename = filename
+        self.disc_vars = dict( (k, list(v)) for k, v in disc_vars.items() )
+        self.dtype = _dtype(cont_vars, disc_vars)
+        if mode == 'a' and os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                dtype, offset = _read_header(f)
+            if dtype != self.dtype:
+                raise ValueError('%s has different columns' % filename)
+            ## drop any partially written record, and anything past start
+            count = (os.path.getsize(filename) - offset) // dtype.itemsize
+            if start is not None and count:
+                count = int(np.searchsorted(read_log(filename)['generation'],
+                        start))
+            self._file = open(filename, 'r+b')
+            self._file.truncate(offset + count*dtype.itemsize)
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self._file = open(filename, 'wb')
+            descr = json.dumps(self.dtype.descr)
+            length = len(MAGIC) + 10 + len(descr) + 2
+            length += -length % _ALIGN
+            header = '%s %8d\n%s\n' % (MAGIC, length, descr)
+            self._file.write(header.ljust(length))
+            self._file.flush()
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._write)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def records(self, generation, orgs, time=0.0):
+        '''Builds the records for a list of organisms.'''
+        records = np.zeros(len(orgs), dtype=self.dtype)
+        records['generation'] = generation
+        records['time'] = time
+        records['id'] = [ org.id for org in orgs ]
+        for name in ['energy_err', 'stress_err', 'force_err', 'fitness']:
+            records[name] = [ getattr(org, name, np.nan) for org in orgs ]
+        for name in self.dtype.names[7:]:
+            if name in self.disc_vars:
+                values = self.disc_vars[name]
+                records[name] = [ values.index(org.genes[name])
+                        if org.genes[name] in values else -1 for org in orgs ]
+            else:
+                records[name] = [ org.genes[name] for org in orgs ]
+        return records
+
+    def append(self, generation, orgs, time=0.0):
+        '''Queues the records of a generation to be written.'''
+        self._queue.put(self.records(generation, orgs, time))
+
+    def _write(self):
+        while True:
+            records = self._queue.get()
+            if records is None:
+                break
+            self._file.write(records.tostring())
+            self._file.flush()
+
+    def close(self):
+        '''Writes out everything queued and closes the log.'''
+        if self._file.closed:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
@@ -0,0 +1,202 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import multiprocessing as mp
+from collections import deque
+from multiprocessing.util import Finalize
+from config import *
+from data import *
+from utils import read_gulp_output
+from genome import gulp_input
+from shared import SharedStructures
+from pool import Backend
+
+__doc__='''
+Event-driven scheduling of GULP runs from the parent process.
+
+Rather than handing evaluations to a pool of workers, which each block on
+their own GULP call, the GulpScheduler starts the GULP processes itself and
+polls them. At most `concurrency` run at once, and any that run longer than
+`timeout` seconds are killed and reported as failed, as a GULP run that
+crashed would be, except that their timings say they timed out (so that the
+Optimizer doesn't cache the failure).
+
+submit() returns an Evaluation, a future-like handle which can be polled
+(done), cancelled, or waited on (result); map() is the synchronous wrapper the
+Optimizer uses.
+'''
+
+class Evaluation(object):
+    '''Handle on an evaluation submitted to a GulpScheduler.'''
+
+    def __init__(self, scheduler, bundle):
+        self.scheduler = scheduler
+        self.bundle = bundle
+        self.state = 'pending'
+        self.timed_out = False
+        self.times = None
+        self._result = None
+
+    def done(self):
+        return self.state in ['done', 'cancelled']
+
+    def cancel(self):
+        self.scheduler._cancel(self)
+
+    def result(self):
+        '''
+        Waits for the evaluation to finish, returning (org_ind, data_ind,
+        result, times) as gulp_call does; result is False if GULP failed, timed
+        out (times['timed_out'] is then set) or was cancelled (in which case
+        times is None).
+        '''
+        self.scheduler.wait([self])
+        return self._result
+
+    def _finish(self, result):
+        org_ind, data_ind, task = self.bundle
+        self._result = (org_ind, data_ind, result, self.times)
+        self.state = 'done'
+
+
+class GulpScheduler(Backend):
+    '''
+    Runs up to `concurrency` (default: one per core) GULP processes at a time,
+    giving each `timeout` seconds (default: no limit) of wall time.
+    '''
+
+    def __init__(self, concurrency=None, timeout=None, poll_interval=0.01):
+        self.concurrency = concurrency or mp.cpu_count()
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.timeouts = 0
+        self._pending = deque()
+        self._running = {}
+        root = SCRATCH_DIR if os.path.isdir(SCRATCH_DIR) else None
+        self._scratch = tempfile.mkdtemp(dir=root, prefix='fitpot-')
+        Finalize(self, shutil.rmtree, args=(self._scratch, True),
+                exitpriority=10)
+
+    def submit(self, bundle):
+        '''Queues a gulp_call bundle, returning its Evaluation.'''
+        evaluation = Evaluation(self, bundle)
+        self._pending.append(evaluation)
+        return evaluation
+
+    def map(self, func, bundles):
+        '''
+        Synchronous equivalent of GulpPool.map for gulp_call; any other
+        function is simply applied in turn.
+        '''
+        if func.__name__ != 'gulp_call':
+            return map(func, bundles)
+        evaluations = [ self.submit(bundle) for bundle in bundles ]
+        self.wait(evaluations)
+        return [ e._result for e in evaluations ]
+
+    def wait(self, evaluations=None):
+        '''Drives the scheduler until evaluations (default: all) are done.'''
+        if evaluations is None:
+            evaluations = list(self._pending) + [ r[0] for r in
+                    self._running.values() ]
+        while not all( e.done() for e in evaluations ):
+            if not self.step():
+                time.sleep(self.poll_interval)
+
+    def step(self):
+        '''
+        Reaps finished and timed out runs and starts pending ones, returning
+        whether anything changed.
+        '''
+        changed = False
+        now = time.time()
+        for slot, (evaluation, p, deadline) in self._running.items():
+            if p.poll() is None:
+                if deadline is None or now < deadline:
+                    continue
+                p.kill()
+                p.wait()
+                self.timeouts += 1
+                evaluation.timed_out = True
+                evaluation.times['gulp'] = now - evaluation.times['started']
+                evaluation.times['timed_out'] = True
+                evaluation._finish(False)
+            else:
+                evaluation.times['gulp'] = now - evaluation.times['started']
+                evaluation._finish(self._collect(slot, evaluation))
+            del self._running[slot]
+            changed = True
+
+        free = [ s for s in range(self.concurrency) if s not in self._running ]
+        while free and self._pending:
+            self._start(free.pop(), self._pending.popleft())
+            changed = True
+        return changed
+
+    def _slot_dir(self, slot):
+        path = os.path.join(self._scratch, 'slot-%d' % slot)
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        return path
+
+    def _start(self, slot, evaluation):
+        start = time.time()
+        org_ind, data_ind, (path, pot_string, shells) = evaluation.bundle
+        data = SharedStructures.attach(path)[data_ind]
+        tmp = self._slot_dir(slot)
+        target = os.path.join(tmp, 'gulp.frc')
+        if os.path.exists(target):
+            os.remove(target)
+        gin = open(os.path.join(tmp, 'gulp.gin'), 'w+')
+        gin.write(gulp_input(data, pot_string, shells))
+        gin.write('output frc '+target+'\n')
+        gin.seek(0)
+        devnull = open(os.devnull, 'w')
+        p = subprocess.Popen(GULP_CMD,
+                cwd=tmp,
+                stdout=devnull,
+                stderr=devnull,
+                stdin=gin)
+        gin.close()
+        devnull.close()
+        started = time.time()
+        ## runs are timed from the parent, one lane per slot
+        evaluation.times = {'pid': os.getpid(), 'tid': slot+1, 'start': start,
+                'render': started-start, 'started': started}
+        deadline = None
+        if self.timeout is not None:
+            deadline = started + self.timeout
+        evaluation.state = 'running'
+        self._running[slot] = (evaluation, p, deadline)
+
+    def _collect(self, slot, evaluation):
+        org_ind, data_ind, (path, pot_string, shells) = evaluation.bundle
+        data = SharedStructures.attach(path)[data_ind]
+        target = os.path.join(self._slot_dir(slot), 'gulp.frc')
+        start = time.time()
+        result = read_gulp_output(target, data_ind, data, shells)
+        evaluation.times['parse'] = time.time() - start
+        return result
+
+    def _cancel(self, evaluation):
+        if evaluation.state == 'pending':
+            self._pending.remove(evaluation)
+        elif evaluation.state == 'running':
+            for slot, (e, p, deadline) in self._running.items():
+                if e is evaluation:
+                    p.kill()
+                    p.wait()
+                    del self._running[slot]
+        else:
+            return
+        evaluation._finish(False)
+        evaluation.state = 'cancelled'
+
+    def close(self):
+        '''Cancels everything outstanding and removes the scratch space.'''
+        for evaluation in list(self._pending) + [ r[0] for r in
+                self._running.values() ]:
+            evaluation.cancel()
+        shutil.rmtree(self._scratch, True)
@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+from collections import OrderedDict
+from multiprocessing.util import Finalize
+from config import *
+from data import Data, DataSet, pack_data
+
+__doc__='''
+Structures shared between the optimizer and its workers.
+
+The optimizer writes the cells, fractional coordinates and species of every
+snapshot it holds to memory-mapped files once. Workers attach to them by path,
+so an evaluation task only needs to carry the organism's parameters and the
+snapshot id, rather than a copy of the structure.
+
+Each worker keeps the snapshots it has read, as Data objects, for the next
+task on them. Only the cache_size most recently used are kept (the Optimizer
+sizes it to its fit set), so a worker doesn't end up with a copy of the whole
+dataset when the fit set rotates through it.
+'''
+
+_attached = (None, None)
+
+class SharedStructures(object):
+    _arrays = ['ids', 'cells', 'offsets', 'coords', 'species']
+
+    def __init__(self, datas=None, root=SCRATCH_DIR, cache_size=0):
+        self.path = None
+        self.cache_size = cache_size
+        if datas is None:
+            return
+        if not os.path.isdir(root):
+            root = None
+        self.path = tempfile.mkdtemp(dir=root, prefix='fitpot-data-')
+        Finalize(self, shutil.rmtree, args=(self.path, True), exitpriority=10)
+
+        if isinstance(datas, DataSet):
+            arrays = datas.pack()
+        else:
+            datas = list(datas)
+            arrays = pack_data(datas)
+            arrays['ids'] = np.array([ d.id for d in datas ], dtype=int)
+        arrays = dict( (name, arrays[name]) for name in self._arrays )
+        for name, array in arrays.items():
+            np.save(os.path.join(self.path, name+'.npy'), array)
+        with open(os.path.join(self.path, 'cache_size'), 'w') as f:
+            f.write('%d\n' % cache_size)
+        self._load()
+
+    @staticmethod
+    def attach(path):
+        '''
+        Returns the SharedStructures stored at path, memory-mapping them the
+        first time the calling process asks for them.
+        '''
+        global _attached
+        if _attached[0] != path:
+            shared = SharedStructures()
+            shared.path = path
+            shared._load()
+            _attached = (path, shared)
+        return _attached[1]
+
+    def _load(self):
+        for name in self._arrays:
+            setattr(self, name, np.load(os.path.join(self.path, name+'.npy'),
+                mmap_mode='r'))
+        self._index = dict( (int(d), i) for i, d in enumerate(self.ids) )
+        with open(os.path.join(self.path, 'cache_size')) as f:
+            self.cache_size = int(f.read())
+        self._snapshots = OrderedDict()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, data_id):
+        '''
+        Returns a Data object holding the structure (cell and coords) of the
+        snapshot data_id, or a list of them for a tuple of ids. The last
+        cache_size objects asked for (all of them, if it is 0) are kept, along
+        with whatever is cached on them (see genome.structure_block).
+        '''
+        if isinstance(data_id, tuple):
+            return [ self[d] for d in data_id ]
+        if data_id in self._snapshots:
+            snapshot = self._snapshots.pop(data_id)
+            self._snapshots[data_id] = snapshot
+            return snapshot
+        row = self._index[data_id]
+        start, end = self.offsets[row], self.offsets[row+1]
+        snapshot = Data()
+        snapshot.id = data_id
+        snapshot.cell = self.cells[row]
+        snapshot.coords = zip(self.species[start:end], self.coords[start:end])
+        self._snapshots[data_id] = snapshot
+        while self.cache_size and len(self._snapshots) > self.cache_size:
+            self._snapshots.popitem(last=False)
+        return snapshot
+
+    def close(self):
+        if self.path and os.path.exists(self.path):
+            shutil.rmtree(self.path, True)
@@ -0,0 +1,85 @@
+import numpy as np
+
+__doc__='''
+Cheap stand-in for GULP when deciding which children are worth evaluating.
+
+A Surrogate remembers the genes and weighted errors of evaluated organisms
+(the most recent `history` of them), and predicts the error of new ones by
+ridge regression on Gaussian radial basis functions centred on the most
+recent `centers` organisms. Genes are encoded as continuous genes scaled to
+their bounds, followed by one indicator per value of each discrete gene; the
+errors are fitted on a log scale.
+'''
+
+class Surrogate(object):
+    '''
+    Regression of log weighted error on genes, for a genome whose gene bounds
+    and discrete values are given as by Optimizer.gene_ranges.
+    '''
+
+    def __init__(self, bounds, values, history=5000, centers=300, ridge=1e-3):
+        self.bounds = np.asarray(bounds, dtype=float).reshape(-1, 2)
+        self.values = values
+        self.history = history
+        self.centers = centers
+        self.ridge = ridge
+        self.seen = -1
+        self.X = np.zeros((0, self.width))
+        self.y = np.zeros(0)
+        self._model = None
+
+    @property
+    def width(self):
+        return len(self.bounds) + sum( len(v) for v in self.values )
+
+    def __len__(self):
+        return len(self.y)
+
+    def encode(self, cont, disc):
+        '''Feature matrix of candidates with the given gene matrices.'''
+        low, high = self.bounds[:,0], self.bounds[:,1]
+        span = np.where(high > low, high - low, 1.0)
+        columns = [ (np.asarray(cont, dtype=float) - low)/span ]
+        for j, values in enumerate(self.values):
+            columns += [ (disc[:,j] == v).astype(float)[:,None]
+                    for v in values ]
+        return np.hstack(columns)
+
+    def add(self, cont, disc, errors):
+        '''Adds evaluated organisms to the history.'''
+        errors = np.asarray(errors, dtype=float)
+        ok = np.isfinite(errors)
+        X = self.encode(cont, disc)[ok]
+        y = np.log(errors[ok] + 1e-12)
+        self.X = np.vstack([self.X, X])[-self.history:]
+        self.y = np.concatenate([self.y, y])[-self.history:]
+        self._model = None
+
+    @staticmethod
+    def _distances(X, centers):
+        d2 = ((X**2).sum(axis=1)[:,None] + (centers**2).sum(axis=1)[None,:]
+                - 2*X.dot(centers.T))
+        return np.maximum(d2, 0)
+
+    def _features(self, X, centers, gamma):
+        d2 = self._distances(X, centers)
+        return np.hstack([np.exp(-gamma*d2), np.ones((len(X), 1))])
+
+    def fit(self):
+        centers = self.X[-self.centers:]
+        d2 = self._distances(centers, centers)
+        scale = np.median(d2[d2 > 1e-12]) if (d2 > 1e-12).any() else 1.0
+        gamma = 1.0/scale
+        phi = self._features(self.X, centers, gamma)
+        a = phi.T.dot(phi) + self.ridge*len(self.y)*np.eye(phi.shape[1])
+        mean = self.y.mean()
+        weights = np.linalg.solve(a, phi.T.dot(self.y - mean))
+        self._model = (centers, gamma, weights, mean)
+
+    def predict(self, cont, disc):
+        '''Predicted log weighted errors of candidates.'''
+        if self._model is None:
+            self.fit()
+        centers, gamma, weights, mean = self._model
+        return mean + self._features(self.encode(cont, disc), centers,
+                gamma).dot(weights)
@@ -0,0 +1,47 @@
+import os
+import sys
+import threading
+
+### Runs on one host, without GULP or any data: the structures are made up
+### (see benchmarks/bench_optimizer.py) and GULP is replaced by the stand-in
+### in benchmarks/fake_gulp.py, slowed down so that workers come and go in
+### the middle of tasks.
+root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+os.environ.setdefault('FITPOT_GULP_CMD',
+        os.path.join(root, 'benchmarks', 'fake_gulp.py'))
+os.environ.setdefault('FITPOT_FAKE_GULP_LATENCY', '0.1')
+sys.path[:0] = [root, os.path.join(root, 'benchmarks')]
+
+from fitpot import Optimizer
+from fitpot.library import LennardJones
+from fitpot.remote import Coordinator, new_key
+from bench_optimizer import synthetic_data
+
+run = Optimizer(LennardJones(elements=['Al']).genome)
+run.data.extend(synthetic_data(20, 8))
+run.evaluator = 'gulp'
+run.pop_size = 20
+run.first_generation_factor = 1
+run.fit_size = 4
+run.checkpoint_every = 0
+
+### Evaluations are handed out to any workers that connect to the
+### coordinator with its key. To take workers from other hosts, listen on an
+### interface they can reach (e.g. ('', 15432)), and start them there with
+###     FITPOT_AUTHKEY=<key> python fitpot/remote.py <this host> <port>
+### Here they run locally, so the coordinator only listens on loopback.
+key = os.environ.get('FITPOT_AUTHKEY') or new_key()
+coordinator = Coordinator(('127.0.0.1', 15432), authkey=key)
+workers = coordinator.spawn_local(2)
+run.engine = coordinator
+
+### one worker leaves (its task goes back in the queue), another joins
+threading.Timer(2.0, workers[0].kill).start()
+threading.Timer(4.0, lambda: workers.extend(coordinator.spawn_local(1))).start()
+
+run(3)
+print 'Workers lost:', coordinator.lost
+coordinator.close()
+for worker in workers:
+    worker.wait()
@@ -53,6 +53,10 @@ genome.functions = {
 ### Constraints, are basically functions, but are evaluated at organism
 ###     creation to ensure, for example, r_0 < r_1, or two types of potentials
 ###     aren't turned on at onces
+###     Constraints written as comparisons of genes, like this one, are checked on
+###     whole batches of organisms at once. Bounds can also be declared, which
+###     keeps the excluded values from ever being drawn (see constraints.py):
+###     from fitpot.constraints import Bound; Bound('sigma', low=2.5)
 genome.constraints = [
         lambda x: x.genes['lennard'] != x.genes['eam']]
 
@@ -2,6 +2,7 @@ from data import *
 import numpy as np
 import os
 import random
+import re
 
 # Function to standardize data (center about 0, divide by stdev to eliminate units)
 def normalize(data):
@@ -19,46 +20,100 @@ def unitize(data):
     data = np.array(data)
     return data/sum(data)
 
+_DECIMALS = re.compile(
+        r'(?<![\d.])[-+]?\d*\.(\d+)(?:[eEdD][-+]?\d+|[-+]\d{3})?(?=\s|$)')
+## mantissa, then the exponent: two or three digits after E (or D), or three
+## after just a sign, as Fortran writes exponents beyond 99 ("1.0-100")
+_FLOAT = (r'([-+]?\d*\.\d{1,%d})(?:[eEdD]([-+]?\d{3}(?![\d.])|[-+]?\d{2})'
+        r'|([-+]\d{3})(?![\d.]))?')
+_STRAY = re.compile(r'\x00\d')
+
+def read_floats(text):
+    '''
+    Returns every real number in text as an array, skipping integers (such as
+    atom indices).
+
+    Fortran doesn't always leave a space between fixed width fields, so
+    numbers may run into each other (e.g. "-1.234567-0.123456" or
+    "1.2345671.234567"). Fields in a block share a number of decimals, which
+    is read off the well-formed numbers in the block and used to split fused
+    ones. Digits left over right after a number mean it could not be read
+    unambiguously, and raise FortranError.
+    '''
+    decimals = [ len(d) for d in _DECIMALS.findall(text) ]
+    if not decimals:
+        if '.' in text:
+            raise FortranError
+        return np.zeros(0)
+    pattern = re.compile(_FLOAT % max(decimals))
+    if _STRAY.search(pattern.sub('\x00', text)):
+        raise FortranError
+    return np.array([ m + 'e' + (e or bare or '0')
+        for m, e, bare in pattern.findall(text) ], dtype=float)
+
+def parse_frc(text, natoms=None):
+    '''
+    Parses the contents of a GULP frc file (one or more structures), returning
+    a list of {'energy', 'forces', 'stresses'} dicts, one per structure. The
+    gradient and strain blocks are decoded in bulk into arrays. If natoms
+    (a list, one per structure) is given, the gradients are checked against
+    it.
+    '''
+    starts = [ m.start() for m in re.finditer(r'^.*energy', text, re.M) ]
+    if not starts:
+        raise GulpError
+    results = []
+    for start, end in zip(starts, starts[1:]+[len(text)]):
+        block = text[start:end]
+        eline, sep, rest = block.partition('\n')
+        energy = read_floats(eline[eline.find('energy')+6:])
+        grad = rest.find('gradients cartesian')
+        strain = rest.find('strain')
+        if not len(energy) or grad < 0 or strain < grad:
+            raise FortranError
+        grad = rest.find('\n', grad)
+        strain_start = rest.find('\n', strain)
+        forces = read_floats(rest[grad:strain])
+        stresses = read_floats(rest[strain_start:]) if strain_start > 0 else []
+        if len(forces) % 3 or len(stresses) % 3:
+            raise FortranError
+        results.append({'energy':energy[0],
+                'forces':forces.reshape(-1, 3),
+                'stresses':np.asarray(stresses, dtype=float)})
+    if natoms is not None:
+        if [ len(r['forces']) for r in results ] != list(natoms):
+            raise FortranError
+    return results
+
+def read_gulp_output(target, data_ind, data, shells=False):
+    '''
+    Reads the frc file GULP wrote to target after evaluating data (a Data
+    object, or a list of them when data_ind is a tuple), returning the result
+    in the form gulp_call reports it, or False if GULP failed.
+    '''
+    structures = data if isinstance(data_ind, tuple) else [data]
+    natoms = None
+    if not shells:
+        natoms = [ len(d.coords) for d in structures ]
+    try:
+        frcout = open(target,'r')
+        result = parse_frc(frcout.read(), natoms)
+        frcout.close()
+    except (IOError, GulpError, FortranError, ValueError):
+        return False
+    if not isinstance(data_ind, tuple):
+        result = result[0]
+    return result
+
 def read_frcout(frcout):
-    energy = 0
-    forces = []
-    stresses = []
-    do_forces = False
-    do_stresses = False
-    for line in frcout:
-        if 'energy' in line:
-            try:
-                energy = float(line.split()[1])
-            except ValueError:
-                raise FortranError
-        if 'gradients cartesian' in line:
-            do_forces = True
-            continue
-        if 'strain' in line:
-            do_forces = False
-            do_stresses = True
-            continue
-        if do_forces:
-            force = []
-            if len(line.split()) != 4:
-                raise FortranError
-            for f in line.split()[1:4]:
-                try:
-                    force.append(float(f))
-                except ValueError:
-                    raise FortranError
-            forces.append(force)
-        if do_stresses:
-            if len(line.split()) != 3:
-                raise FortranError
-            for s in line.split():
-                try:
-                    stresses.append(float(s))
-                except ValueError:
-                    raise FortranError
-    return {'energy':energy,
-            'forces':np.array(forces),
-            'stresses':np.array(stresses)}
+    return parse_frc(''.join(frcout))[0]
+
+def read_frcouts(frcout):
+    '''
+    Reads the output of a multi-structure GULP run, returning one result (as
+    in read_frcout) per structure, in input order.
+    '''
+    return parse_frc(''.join(frcout))
 
 def ensure_length(line):
     if len(line) > 80: